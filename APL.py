@@ -1,5 +1,10 @@
 from mylist import *
 import array as arr
+from itertools import repeat
+from math import isqrt
+import mmap
+import os
+from typing import Iterator
 
 class PointerListIterator:
     ''' Iterator class to make MyList iterable.
@@ -7,13 +12,17 @@ class PointerListIterator:
     '''
 
     def __init__(self, lst):
-        self._lst: PointerList = lst
-        self._index: int = 0
+        # cursor on the node holding the next value
+        self._node: Node = lst.head
+
+    def __iter__(self) -> 'PointerListIterator':
+        return self
 
     def __next__(self):
-        if len(self._lst) > self._index:
-            value = self._lst[self._index]
-            self._index += 1
+        '''Returns the next value and advances the cursor by one node.'''
+        if self._node is not None:
+            value = self._node.value
+            self._node = self._node.next
             return value
         # End of Iteration
         else:
@@ -22,13 +31,22 @@ class PointerListIterator:
 
 class Node:
 
-    def __init__(self, value=None):
+    def __init__(self, value=None, prev=None):
         self.value = value
         self.next = None
+        self.prev = prev
 
 
 class PointerList:
-    '''list interface.'''
+    '''list interface.
+    Nodes are doubly linked, and the list keeps a tail pointer, so walks may
+    go backwards as well as forwards. Alongside the chain of nodes the list
+    keeps a skip index: a table of every k-th node, with k about the square
+    root of the size, rebuilt lazily after inserts. It also keeps a finger
+    on the last node accessed. Access to index i walks from whichever of
+    the nearest indexed nodes, the tail and the finger is closest, so random
+    access costs O(sqrt n) and access near the previous one O(distance).
+    '''
 
     def __init__(self, size: int, value=None) -> None:
         """Creates a list of the given size, optionally intializing elements to value.
@@ -40,24 +58,48 @@ class PointerList:
         none
         """
         self.head = None
+        self.tail = None
         self.size = 0
-
-        for i in range(size):
-            self.insert(i, value)
+        # skip index: _skip[j] is the node at position j * _stride
+        self._skip = None
+        self._stride = 1
+        # finger: the last node accessed and its position
+        self._finger = None
+        self._finger_at = 0
+        # number of writes through the methods of the list, so that values
+        # derived from its elements can tell when they are stale
+        self.version = 0
+
+        self.extend(repeat(value, size))
+
+    @classmethod
+    def from_iterable(cls, values) -> 'PointerList':
+        '''Creates a list holding the given values, in order, in O(n).
+        Args:
+        - values: an iterable of the values to store.
+        Returns:
+        the created list.
+        '''
+        lst = cls(0)
+        lst.extend(values)
+        return lst
 
     def __len__(self):
         length_p = self.size
         return length_p
 
-    def __iter__(self) -> PointerListIterator:
+    def __iter__(self) -> Iterator:
         '''Returns an iterator that allows iteration over this list.
+        The generator follows the next pointers, so a full scan is O(n).
         Ref: https://thispointer.com/python-how-to-make-a-class-iterable-create-iterator-class-for-it/
         Args:
         Returns:
         an iterator that allows iteration over this list.
         '''
-        p_iterator = PointerListIterator(self)
-        return p_iterator
+        node = self.head
+        while node is not None:
+            yield node.value
+            node = node.next
 
     def __getitem__(self, i: int):
         '''Returns the value at index, i.
@@ -67,11 +109,7 @@ class PointerList:
         Returns:
         the value at index i.
         '''
-        universal = self.head
-        for index in range(i):
-            universal = universal.next
-        else:
-            return universal.value
+        return self._node(i).value
 
     def __setitem__(self, i: int, value) -> None:
         '''Sets the element at index, i, to value.
@@ -82,30 +120,161 @@ class PointerList:
         Returns:
         none
         '''
-        universal = self.head
-        for index in range(i):
-            universal = universal.next
+        self._node(i).value = value
+        self.version += 1
+
+    def _get_unchecked(self, i: int):
+        '''Returns the value at index, i, without checking that i is in bounds.
+        This is an internal function for callers that have checked their
+        indices already.
+        Args:
+        - i: the index from which to retrieve the value.
+        Returns:
+        the value at index i.
+        '''
+        return self._seek(i).value
+
+    def _set_unchecked(self, i: int, value) -> None:
+        '''Sets the element at index, i, to value without checking that i is in
+        bounds. See _get_unchecked.
+        Args:
+        - i: the index of the element to be set
+        - value: the value to be set
+        Returns:
+        none
+        '''
+        self._seek(i).value = value
+        self.version += 1
+
+    def _node(self, i: int) -> Node:
+        '''Returns the node at index, i, and moves the finger onto it.
+        This is an internal function for use in class methods only.
+        Args:
+        - i: the index of the node.
+        Returns:
+        the node at index i.
+        '''
+        assert 0 <= i < self.size,\
+            f'Invalid list index {i} for list of size {self.size}'
+        return self._seek(i)
+
+    def _seek(self, i: int) -> Node:
+        '''Returns the node at index, i, which must be in bounds, and moves the
+        finger onto it. The walk starts from the closest of the skip index
+        entries around i, the tail and the finger.
+        This is an internal function for use in class methods only.
+        Args:
+        - i: the index of the node.
+        Returns:
+        the node at index i.
+        '''
+        if self._skip is None:
+            self._build_skip()
+        j = i // self._stride
+        start, node = j * self._stride, self._skip[j]
+        if j + 1 < len(self._skip) and (j+1) * self._stride - i < i - start:
+            start, node = (j+1) * self._stride, self._skip[j+1]
+        if self.size - 1 - i < abs(i - start):
+            start, node = self.size - 1, self.tail
+        if self._finger is not None and \
+                abs(i - self._finger_at) < abs(i - start):
+            start, node = self._finger_at, self._finger
+        node = self._walk(node, i - start)
+        self._finger, self._finger_at = node, i
+        return node
+
+    def _walk(self, node: Node, steps: int) -> Node:
+        '''Returns the node steps positions after node, or before if negative.
+        This is an internal function for use in class methods only.
+        Args:
+        - node: the node to start from.
+        - steps: the number of links to follow.
+        Returns:
+        the node reached.
+        '''
+        if steps >= 0:
+            for index in range(steps):
+                node = node.next
         else:
-            universal.value = value
+            for index in range(-steps):
+                node = node.prev
+        return node
+
+    def _build_skip(self) -> None:
+        '''Rebuilds the skip index with one entry per sqrt(size) nodes.
+        This is an internal function for use in class methods only.
+        Args:
+        Returns:
+        none
+        '''
+        self._stride = max(1, isqrt(self.size))
+        self._skip = []
+        node = self.head
+        index = 0
+        while node is not None:
+            if index % self._stride == 0:
+                self._skip.append(node)
+            node = node.next
+            index += 1
+
+
+    def append(self, value) -> None:
+        '''Adds value at the end of the list in O(1) using the tail pointer.
+        Args:
+        - value: the value to be added
+        Returns:
+        none
+        '''
+        self.extend((value,))
 
+    def extend(self, values) -> None:
+        '''Adds the given values, in order, at the end of the list.
+        Each value costs O(1) as nodes are linked after the tail.
+        Args:
+        - values: an iterable of the values to be added
+        Returns:
+        none
+        '''
+        # a placeholder in front of the head lets an empty list be extended
+        # the same way as a non-empty one
+        placeholder = Node()
+        tail = self.tail or placeholder
+        count = 0
+        for value in values:
+            tail.next = tail = Node(value, tail)
+            count += 1
+        if count:
+            if self.head is None:
+                self.head = placeholder.next
+                self.head.prev = None
+            self.tail = tail
+            self.size += count
+            self._skip = None
+            self.version += 1
 
     def insert(self, i, value):
 
+        if i >= self.size:
+            self.append(value)
+            return
         temporary_t_node = Node(value)
-        if self.size == 0:
-            self.head = temporary_t_node
-        elif i == 0:
+        if i == 0:
             temporary_t_node.next = self.head
+            self.head.prev = temporary_t_node
             self.head = temporary_t_node
 
         else:
-            universal = self.head
-            for index in range(i-1):
-                universal = universal.next
+            universal = self._node(i-1)
 
+            temporary_t_node.prev = universal
             temporary_t_node.next = universal.next
+            universal.next.prev = temporary_t_node
             universal.next = temporary_t_node
         self.size = self.size + 1
+        # positions after i have shifted, so the skip index and finger are stale
+        self._skip = None
+        self._finger = None
+        self.version += 1
 
     def set(self, i: int, value) -> None:
         '''Sets the element at index, i, to value.
@@ -128,6 +297,44 @@ class PointerList:
         '''
         return self[i]
 
+    def frombytes(self, data) -> None:
+        '''Replaces the contents of the list with packed RGB bytes.
+        The nodes are visited once, in order, instead of walking from the
+        head for every element.
+        Args:
+        - data: bytes holding 3 channel values per element.
+        Returns:
+        none
+        '''
+        assert len(data) == 3 * self.size,\
+            f'Loading {len(data)} bytes into list of size {self.size}'
+        node = self.head
+        for i in range(0, len(data), 3):
+            node.value = tuple(data[i:i+3])
+            node = node.next
+        self.version += 1
+
+    def tobytes(self) -> bytes:
+        '''Returns the contents of the list as packed RGB bytes.
+        Args:
+        Returns:
+        the channel values of all elements, one byte per channel.
+        '''
+        data = bytearray()
+        node = self.head
+        while node is not None:
+            data += bytes(node.value)
+            node = node.next
+        return bytes(data)
+
+    def copy(self) -> 'PointerList':
+        '''Returns a new list holding the same elements, in O(n).
+        Args:
+        Returns:
+        the copy.
+        '''
+        return PointerList.from_iterable(self)
+
 
 class ArrayListIterator:
     ''' Iterator class to make MyList iterable.
@@ -135,25 +342,31 @@ class ArrayListIterator:
     '''
 
     def __init__(self, lst):
-        # MyList object reference
-        self._lst: ArrayList = lst
-        # member variable to keep track of current index
-        self._index: int = 0
+        # backing array of the ArrayList
+        self._data = lst.lst
+        # offset of the first channel of the next value in the array
+        self._offset: int = 0
+
+    def __iter__(self) -> 'ArrayListIterator':
+        return self
 
     def __next__(self):
         ''''Returns the next value from the stored MyList instance.'''
-        if len(self._lst) > self._index:
-            value = self._lst[self._index]
-            self._index
-            self._index = self._index + 1
-            return value
+        offset = self._offset
+        if offset < len(self._data):
+            self._offset = offset + 3
+            return (self._data[offset], self._data[offset+1],
+                    self._data[offset+2])
         # End of Iteration
         else:
             raise StopIteration
 
 
 class ArrayList:
-    '''A list interface.'''
+    '''A list interface.
+    Elements are RGB triples stored interleaved in a byte array, one byte
+    per channel, so the buffer has the same layout as PIL's raw RGB data.
+    '''
 
     def __init__(self, size: int, value=None) -> None:
         """Creates a list of the given size, optionally intializing elements to value.
@@ -165,10 +378,11 @@ class ArrayList:
         none
         """
         if value:
-            temp = [value[0], value[1], value[2]]*size
-            self.lst = arr.array('I', temp)
+            self.lst = arr.array('B', value[:3]) * size
         else:
-            self.lst = arr.array('I', [0]*3*size)
+            self.lst = arr.array('B', [0, 0, 0]) * size
+        # number of writes through the methods of the list, see PointerList
+        self.version = 0
 
     def __len__(self) -> int:
         '''Returns the size of the list. Allows len() to be called on it.
@@ -177,7 +391,7 @@ class ArrayList:
         Returns:
         the size of the list.
         '''
-        return int(len(self.lst) / 3)
+        return len(self.lst) // 3
 
     def __getitem__(self, i: int):
         '''Returns the value at index, i. Allows indexing syntax.
@@ -204,21 +418,51 @@ class ArrayList:
         '''
         # Ensure bounds
         assert 0 <= i < len(self),\
-            f'Setting invalid list index {i} in list of size {self.size()}'
+            f'Setting invalid list index {i} in list of size {len(self)}'
 
         self.lst[3*i] = value[0]
         self.lst[(3*i)+1] = value[1]
         self.lst[(3*i)+2] = value[2]
+        self.version += 1
+
+    def _get_unchecked(self, i: int):
+        '''Returns the value at index, i, without checking that i is in bounds.
+        This is an internal function for callers that have checked their
+        indices already, e.g. against the bounds of a loop.
+        Args:
+        - i: the index from which to retrieve the value.
+        Returns:
+        the value at index i.
+        '''
+        lst = self.lst
+        i *= 3
+        return (lst[i], lst[i+1], lst[i+2])
+
+    def _set_unchecked(self, i: int, value) -> None:
+        '''Sets the element at index, i, to value without checking that i is in
+        bounds. See _get_unchecked.
+        Args:
+        - i: the index of the element to be set
+        - value: the value to be set
+        Returns:
+        none
+        '''
+        lst = self.lst
+        i *= 3
+        lst[i], lst[i+1], lst[i+2] = value[0], value[1], value[2]
+        self.version += 1
 
-    def __iter__(self) -> MyListIterator:
+    def __iter__(self) -> Iterator:
         '''Returns an iterator that allows iteration over this list.
+        Consecutive channels of the backing array are grouped into tuples
+        by zip, so no per-element index arithmetic or bounds check is done.
         Ref: https://thispointer.com/python-how-to-make-a-class-iterable-create-iterator-class-for-it/
         Args:
         Returns:
         an iterator that allows iteration over this list.
         '''
-        a_iterator = ArrayListIterator(self)
-        return a_iterator
+        channels = iter(self.lst)
+        yield from zip(channels, channels, channels)
 
     def get(self, i: int):
         '''Returns the value at index, i.
@@ -240,3 +484,240 @@ class ArrayList:
         none
         '''
         self[i] = value
+
+    def frombytes(self, data) -> None:
+        '''Replaces the contents of the list with packed RGB bytes in one step.
+        The bytes are copied into the backing array, so views of the list
+        keep seeing its contents.
+        Args:
+        - data: bytes holding 3 channel values per element, e.g. the output
+          of PIL's Image.tobytes() for an RGB image.
+        Returns:
+        none
+        '''
+        assert len(data) == len(self.lst),\
+            f'Loading {len(data)} bytes into list of {len(self.lst)} channels'
+        memoryview(self.lst)[:] = data
+        self.version += 1
+
+    def tobytes(self) -> bytes:
+        '''Returns the contents of the list as packed RGB bytes.
+        The result can be handed straight to PIL's Image.frombytes().
+        Args:
+        Returns:
+        the channel values of all elements, one byte per channel.
+        '''
+        return self.lst.tobytes()
+
+    def view(self) -> memoryview:
+        '''Returns a writable view of the backing buffer without copying it.
+        The view holds 3 bytes per element in RGB order. Writes through it
+        do not change the version of the list.
+        Args:
+        Returns:
+        a memoryview over the channel bytes of the list.
+        '''
+        return memoryview(self.lst)
+
+    def copy(self) -> 'ArrayList':
+        '''Returns a new list holding the same elements.
+        The backing array is copied in one step.
+        Args:
+        Returns:
+        the copy.
+        '''
+        lst = ArrayList(0)
+        lst.lst = self.lst[:]
+        return lst
+
+
+class MappedList:
+    '''A list interface over a memory-mapped file.
+    Elements are RGB triples stored as in ArrayList, 3 bytes per element,
+    in the file from a given offset on. The operating system reads the
+    pages of the file in as they are touched and writes changed pages
+    back, so the list can be larger than memory.
+    '''
+
+    def __init__(self, path: str, size: int, offset: int = 0,
+                 readonly: bool = False) -> None:
+        """Maps size elements of the file at path, starting at byte offset.
+        The file is not resized; it must already hold the elements.
+        Args:
+        - path: path to the file.
+        - size: the number of elements in the list.
+        - offset: the position in the file of the first element.
+        - readonly: if True then the list cannot be written to.
+        Returns:
+        none
+        """
+        with open(path, 'rb' if readonly else 'r+b') as f:
+            length = offset + 3 * size
+            assert os.fstat(f.fileno()).st_size >= length,\
+                f'File {path} is too short for {size} elements'
+            self._mm = mmap.mmap(
+                f.fileno(), length,
+                access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        self._span = slice(offset, length)
+        self._base = memoryview(self._mm)
+        self.lst = self._base[self._span]
+        # number of writes through the methods of the list, see PointerList
+        self.version = 0
+
+    def __len__(self) -> int:
+        '''Returns the size of the list. Allows len() to be called on it.
+        Args:
+        Returns:
+        the size of the list.
+        '''
+        return len(self.lst) // 3
+
+    def __getitem__(self, i: int):
+        '''Returns the value at index, i. Allows indexing syntax.
+        Args:
+        - i: the index from which to retrieve the value.
+        Returns:
+        the value at index i.
+        '''
+        # Ensure bounds.
+        assert 0 <= i < len(self),\
+            f'Getting invalid list index {i} from list of size {len(self)}'
+
+        return tuple(self.lst[3*i:3*i+3])
+
+    def __setitem__(self, i: int, value) -> None:
+        '''Sets the element at index, i, to value. Allows indexing syntax.
+        Args:
+        - i: the index of the elemnent to be set
+        - value: the value to be set
+        Returns:
+        none
+        '''
+        # Ensure bounds
+        assert 0 <= i < len(self),\
+            f'Setting invalid list index {i} in list of size {len(self)}'
+
+        self.lst[3*i:3*i+3] = bytes(value[:3])
+        self.version += 1
+
+    def _get_unchecked(self, i: int):
+        '''Returns the value at index, i, without checking that i is in bounds.
+        This is an internal function for callers that have checked their
+        indices already.
+        Args:
+        - i: the index from which to retrieve the value.
+        Returns:
+        the value at index i.
+        '''
+        return tuple(self.lst[3*i:3*i+3])
+
+    def _set_unchecked(self, i: int, value) -> None:
+        '''Sets the element at index, i, to value without checking that i is in
+        bounds. See _get_unchecked.
+        Args:
+        - i: the index of the element to be set
+        - value: the value to be set
+        Returns:
+        none
+        '''
+        self.lst[3*i:3*i+3] = bytes(value[:3])
+        self.version += 1
+
+    def __iter__(self) -> Iterator:
+        '''Returns an iterator that allows iteration over this list.
+        Args:
+        Returns:
+        an iterator that allows iteration over this list.
+        '''
+        channels = iter(self.lst)
+        yield from zip(channels, channels, channels)
+
+    def get(self, i: int):
+        '''Returns the value at index, i.
+        Alternate to use of indexing syntax.
+        Args:
+        - i: the index from which to retrieve the value.
+        Returns:
+        the value at index i.
+        '''
+        return self[i]
+
+    def set(self, i: int, value) -> None:
+        '''Sets the element at index, i, to value.
+        Alternate to use of indexing syntax.
+        Args:
+        - i: the index of the elemnent to be set
+        - value: the value to be set
+        Returns:
+        none
+        '''
+        self[i] = value
+
+    def frombytes(self, data) -> None:
+        '''Overwrites the contents of the list with packed RGB bytes.
+        Args:
+        - data: bytes holding 3 channel values per element.
+        Returns:
+        none
+        '''
+        assert len(data) == len(self.lst),\
+            f'Loading {len(data)} bytes into list of {len(self.lst)} channels'
+        self.lst[:] = data
+        self.version += 1
+
+    def tobytes(self) -> bytes:
+        '''Returns the contents of the list as packed RGB bytes.
+        This reads the whole mapped region into memory.
+        Args:
+        Returns:
+        the channel values of all elements, one byte per channel.
+        '''
+        return self.lst.tobytes()
+
+    def view(self) -> memoryview:
+        '''Returns a view of the mapped bytes without copying them.
+        The view holds 3 bytes per element in RGB order. It is writable
+        unless the list was mapped readonly; writes through it do not change
+        the version of the list.
+        Args:
+        Returns:
+        a memoryview over the channel bytes of the list.
+        '''
+        return self.lst[:]
+
+    def copy(self) -> ArrayList:
+        '''Returns an in-memory list holding the same elements.
+        Args:
+        Returns:
+        the copy.
+        '''
+        lst = ArrayList(0)
+        lst.lst.frombytes(self.lst)
+        return lst
+
+    def flush(self) -> None:
+        '''Writes changed elements back to the file.
+        Args:
+        Returns:
+        none
+        '''
+        if not self.lst.readonly:
+            self._mm.flush()
+
+    def close(self) -> None:
+        '''Flushes and unmaps the file. The list cannot be used afterwards.
+        Views returned by view() must have been released; if any is still
+        held, BufferError is raised and the list stays usable.
+        Args:
+        Returns:
+        none
+        '''
+        self.flush()
+        self.lst.release()
+        self._base.release()
+        try:
+            self._mm.close()
+        except BufferError:
+            self._base = memoryview(self._mm)
+            self.lst = self._base[self._span]
+            raise
@@ -0,0 +1,331 @@
+"""Benchmarks of the image operations on array- and pointer-based images.
+
+Every operation in image_operations is timed on both backends over a sweep
+of image sizes, and apply_mask also over a sweep of mask sizes, over each
+kind of mask (see MASK_KINDS) and each engine. Images and masks are
+synthetic and seeded, so runs are reproducible and need no network:
+
+    python benchmark.py run -o before.json
+    python benchmark.py run -o after.json
+    python benchmark.py compare before.json after.json
+
+Each result records the best time over a number of repeats, and, from a
+separate traced run, the peak memory allocated by the operation and the
+number of memory blocks it allocated that are still allocated on return,
+such as those of its result.
+"""
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tracemalloc
+
+from PIL import Image
+
+from image_operations import MyImage, apply_mask, remove_channel, rotations
+import convolution
+
+SIZES = (32, 64, 128)
+MASK_SIZES = (3, 5, 9)
+# the masks apply_mask is benchmarked with, as each takes its own path:
+# all weights equal, a product of a column and a row, and neither
+MASK_KINDS = ('box', 'separable', 'general')
+# get/set calls per access benchmark
+ACCESSES = 1000
+
+
+def synthetic_image(path: str, side: int, seed: int = 0) -> None:
+    """Writes a square image of random pixels to path.
+
+    Args:
+    - path: the image file to write; the format follows its extension.
+    - side: the width and height of the image.
+    - seed: seed of the random pixels.
+
+    Returns:
+    none
+    """
+    rng = random.Random(seed)
+    data = bytes(rng.getrandbits(8) for i in range(3 * side * side))
+    Image.frombytes('RGB', (side, side), data).save(path)
+
+
+def synthetic_mask(path: str, size: int, kind: str, seed: int = 0) -> None:
+    """Writes a size x size mask of random positive weights to path, in the
+    format of the mask files.
+
+    Args:
+    - path: the mask file to write.
+    - size: the side length of the mask.
+    - kind: one of MASK_KINDS; 'box' masks are all ones, 'separable' ones
+      the product of a random column and row, and 'general' ones are
+      neither.
+    - seed: seed of the random weights.
+
+    Returns:
+    none
+    """
+    rng = random.Random(seed)
+    if kind == 'box':
+        weights = [1] * size * size
+    elif kind == 'separable':
+        column = [rng.randint(1, 9) for x in range(size)]
+        row = [rng.randint(1, 9) for y in range(size)]
+        weights = [w * v for w in column for v in row]
+    else:
+        weights = [1] * size * size
+        while size > 1 and convolution.separate(weights, size):
+            weights = [rng.randint(1, 9) for i in range(size * size)]
+    with open(path, 'w') as f:
+        f.write('\n'.join(map(str, [size] + weights)) + '\n')
+
+
+def coordinates(size: (int, int), seed: int = 0) -> list:
+    """Returns ACCESSES random pairs of pixel coordinates in an image.
+
+    Args:
+    - size: (width, height) of the image.
+    - seed: seed of the random coordinates.
+
+    Returns:
+    a list of (r, c, r2, c2) tuples.
+    """
+    rng = random.Random(seed)
+    width, height = size
+    return [(rng.randrange(height), rng.randrange(width),
+             rng.randrange(height), rng.randrange(width))
+            for i in range(ACCESSES)]
+
+
+def access(img: MyImage, pixels: list, unchecked: bool = False) -> None:
+    """Copies pixel (r, c) of img to pixel (r2, c2) for each of pixels.
+
+    Args:
+    - img: the image to read from and write to.
+    - pixels: (r, c, r2, c2) tuples, as returned by coordinates.
+    - unchecked: use the internal accessors that skip bounds checks; the
+      coordinates are in bounds by construction.
+
+    Returns:
+    none
+    """
+    if unchecked:
+        img._own()
+        get, set = img._get_unchecked, img._set_unchecked
+    else:
+        get, set = img.get, img.set
+    for r, c, r2, c2 in pixels:
+        set(r2, c2, get(r, c))
+
+
+def cases(directory: str, sizes=SIZES, mask_sizes=MASK_SIZES):
+    """Yields the benchmarks to run, writing their input files to directory.
+
+    apply_mask is run with every engine available: 'python', and 'numpy'
+    and 'fft' if numpy is installed.
+
+    Args:
+    - directory: where the synthetic images and masks are written.
+    - sizes: the sides of the square images to benchmark on.
+    - mask_sizes: the sides of the masks to benchmark apply_mask with.
+
+    Returns:
+    a generator of (name, setup) pairs: name identifies the benchmark and
+    setup() returns the function to time, with its inputs prepared.
+    """
+    engines = ('python',) if convolution.np is None else \
+        ('python', 'numpy', 'fft')
+    masks = {}
+    for mask_size in mask_sizes:
+        for kind in MASK_KINDS:
+            masks[mask_size, kind] = maskfile = \
+                os.path.join(directory, f'mask{mask_size}-{kind}.txt')
+            synthetic_mask(maskfile, mask_size, kind, seed=mask_size)
+    for side in sizes:
+        source = os.path.join(directory, f'{side}.png')
+        synthetic_image(source, side, seed=side)
+        output = os.path.join(directory, 'output.png')
+        for pointer in (False, True):
+            backend = 'pointer' if pointer else 'array'
+
+            def opened(source=source, pointer=pointer):
+                return MyImage.open(source, pointer=pointer)
+
+            def key(op, *parameters):
+                return '/'.join(map(str, (op, backend, side) + parameters))
+
+            yield key('open'), lambda opened=opened: opened
+            yield key('save'), lambda opened=opened: \
+                lambda img=opened(): img.save(output)
+            pixels = coordinates((side, side))
+            yield key('access'), lambda opened=opened: \
+                lambda img=opened(): access(img, pixels)
+            yield key('access_unchecked'), lambda opened=opened: \
+                lambda img=opened(): access(img, pixels, unchecked=True)
+            yield key('remove_channel'), lambda opened=opened: \
+                lambda img=opened(): remove_channel(img, green=True)
+            yield key('rotations'), lambda opened=opened: \
+                lambda img=opened(): rotations(img)
+            for (mask_size, kind), maskfile in masks.items():
+                for engine in engines:
+                    yield key('apply_mask', mask_size, kind, engine), \
+                        lambda opened=opened, maskfile=maskfile, \
+                        engine=engine: lambda img=opened(): \
+                        apply_mask(img, maskfile, engine=engine)
+
+
+def measure(function, repeat: int = 3) -> dict:
+    """Times function and traces the memory it allocates.
+
+    Args:
+    - function: the function to benchmark, called without arguments.
+    - repeat: the number of timed calls; the best time is kept.
+
+    Returns:
+    a dict of seconds, peak_bytes and retained_blocks: the number of blocks
+    allocated by function that are still allocated when it returns. Blocks
+    it allocates and frees again only show in peak_bytes.
+    """
+    # as in timeit, the garbage collector does not run during measurements;
+    # the cycles of doubly linked pointer lists are collected between them
+    enabled = gc.isenabled()
+    seconds = float('inf')
+    try:
+        for i in range(repeat):
+            gc.collect()
+            gc.disable()
+            start = perf_counter()
+            function()
+            seconds = min(seconds, perf_counter() - start)
+            if enabled:
+                gc.enable()
+
+        gc.collect()
+        gc.disable()
+        tracemalloc.start()
+        try:
+            result = function()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            # only blocks allocated since tracing started are traced, so
+            # blocks the function frees do not offset those it allocates
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        retained_blocks = sum(stat.count
+                              for stat in snapshot.statistics('filename'))
+        del result
+    finally:
+        if enabled:
+            gc.enable()
+    return dict(seconds=seconds, peak_bytes=peak_bytes,
+                retained_blocks=retained_blocks)
+
+
+def run(sizes=SIZES, mask_sizes=MASK_SIZES, repeat: int = 3,
+        pattern: str = '') -> dict:
+    """Runs the benchmarks.
+
+    Args:
+    - sizes, mask_sizes: as for cases.
+    - repeat: as for measure.
+    - pattern: only benchmarks whose names contain pattern are run.
+
+    Returns:
+    a dict holding the environment of the run under 'environment', and the
+    measurements of each benchmark under 'results', keyed by its name.
+    """
+    results = {}
+    if convolution.np is not None:
+        # measure the numpy engine's FFT threshold now rather than in a run
+        convolution.fft_min_size()
+    with TemporaryDirectory() as directory:
+        for name, setup in cases(directory, sizes, mask_sizes):
+            if pattern in name:
+                results[name] = measure(setup(), repeat)
+    environment = dict(python=platform.python_version(),
+                       platform=platform.platform(),
+                       numpy=None if convolution.np is None
+                       else convolution.np.__version__,
+                       fft_min_size=convolution.FFT_MIN_SIZE, repeat=repeat)
+    return dict(environment=environment, results=results)
+
+
+def compare(old: dict, new: dict, threshold: float = 0.2) -> list:
+    """Returns the benchmarks that got slower or used more memory.
+
+    Args:
+    - old, new: the outputs of two runs.
+    - threshold: the relative increase above which a change is flagged.
+
+    Returns:
+    (name, measure, old value, new value) for each regression, for the
+    benchmarks and measures present in both runs.
+    """
+    regressions = []
+    for name, before in old['results'].items():
+        after = new['results'].get(name)
+        if after is None:
+            continue
+        for measure in ('seconds', 'peak_bytes'):
+            if after[measure] > before[measure] * (1 + threshold):
+                regressions.append((name, measure, before[measure],
+                                    after[measure]))
+    return regressions
+
+
+def main(argv=None) -> int:
+    """Runs the command line, see the module docstring.
+
+    Args:
+    - argv: the command line arguments; defaults to sys.argv[1:].
+
+    Returns:
+    the exit status: 1 if compare found regressions, else 0.
+    """
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('-o', '--output', help='JSON file to write')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    run_parser.add_argument('--mask-sizes', type=int, nargs='+',
+                            default=MASK_SIZES)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('-k', '--pattern', default='',
+                            help='only run benchmarks whose names contain this')
+    compare_parser = commands.add_parser('compare',
+                                         help='flag regressions between runs')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        report = run(args.sizes, args.mask_sizes, args.repeat, args.pattern)
+        for name, result in report['results'].items():
+            print(f'{name:>40}: {result["seconds"] * 1e3:10.3f} ms '
+                  f'{result["peak_bytes"] / 1024:10.1f} KiB peak '
+                  f'{result["retained_blocks"]:6} blocks retained')
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        return 0
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = compare(old, new, args.threshold)
+    for name, measure, before, after in regressions:
+        change = f' ({after / before - 1:+.0%})' if before else ''
+        print(f'{name}: {measure} {before:.6g} -> {after:.6g}{change}')
+    print(f'{len(regressions)} regressions above {args.threshold:.0%}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,907 @@
+"""Convolution engines used by image_operations.apply_mask.
+
+gray_plane turns the raw RGB bytes of an image into its grayscale plane, one
+byte per pixel holding the floor of the mean of the pixel's 3 channels.
+Each engine takes a gray plane and returns the masked gray plane, with the
+same semantics as the original per-pixel loop of apply_mask:
+- mask taps falling outside the image are dropped, from the weighted sum
+  and from the averaging denominator alike,
+- averaged results are floored, and every result is clamped to 0..255.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, reduce
+from itertools import accumulate
+from math import gcd
+from multiprocessing.shared_memory import SharedMemory
+from operator import mul
+from time import perf_counter
+import os
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; apply_mask falls back to python.
+    np = None
+
+# Under the numpy engine, masks of this size and up that are neither
+# separable nor uniform are applied by convolve_fft. None until measured by
+# fft_min_size; set it to skip the measurement.
+FFT_MIN_SIZE = None
+# mask sizes tried by fft_min_size, and the side of the image it uses
+_TUNE_SIZES = range(3, 33, 2)
+_TUNE_SIDE = 128
+# pixels per band of rows masked at a time by convolve_banded
+BAND_PIXELS = 1 << 18
+
+
+def separate(weights: list, size: int) -> (list, list):
+    """Splits a rank-1 mask into a column and a row of integer weights.
+
+    A mask is separable when every row is a multiple of one row vector; the
+    mask is then the outer product column x row and can be applied as a
+    horizontal pass followed by a vertical pass. Dividing the first non-zero
+    row by the gcd of its entries makes both factors integral whenever the
+    mask is separable at all, so the two passes stay exact.
+
+    Args:
+    - weights: the size*size mask weights in row-major order.
+    - size: the side length of the (square) mask.
+
+    Returns:
+    (column, row) such that weights[x*size + y] == column[x] * row[y],
+    or None if the mask is not separable.
+    """
+    rows = [weights[x*size:(x+1)*size] for x in range(size)]
+    pivot = next((line for line in rows if any(line)), None)
+    if pivot is None:
+        return None
+    divisor = reduce(gcd, pivot)
+    row = [w // divisor for w in pivot]
+    y = next(y for y, w in enumerate(row) if w)
+    column = []
+    for line in rows:
+        if line[y] % row[y]:
+            return None
+        factor = line[y] // row[y]
+        if any(factor * v != w for v, w in zip(row, line)):
+            return None
+        column.append(factor)
+    return column, row
+
+
+class Mask:
+    """A square convolution mask with everything apply_mask derives from it.
+
+    Besides the weights, a mask holds its separable factors, if any, its
+    weight if all weights are the same, and a table of prefix sums of its
+    weights. The averaging denominator of a
+    pixel is the sum of the weights of its in-bounds taps, which always form
+    a rectangle of the mask, so the table yields it in O(1).
+    """
+
+    def __init__(self, size: int, weights: list) -> None:
+        """Creates a mask from its size and its row-major weights.
+
+        Args:
+        - size: the side length of the (square) mask.
+        - weights: the size*size mask weights in row-major order.
+
+        Returns:
+        none
+        """
+        assert len(weights) == size * size,\
+            f'{len(weights)} weights do not fill a mask of size {size}'
+        self.size = size
+        self.weights = list(weights)
+        self.factors = separate(self.weights, size)
+        # the weight shared by all taps of a box mask, else None
+        self.uniform = weights[0] if weights and weights[0] and \
+            weights.count(weights[0]) == len(weights) else None
+        # _sums[x][y] is the sum of the weights in rows < x and columns < y.
+        self._sums = [[0] * (size + 1) for x in range(size + 1)]
+        for x in range(size):
+            for y in range(size):
+                self._sums[x+1][y+1] = (weights[x*size + y] + self._sums[x][y+1]
+                                        + self._sums[x+1][y] - self._sums[x][y])
+        self.total = self._sums[size][size]
+
+    def weight_sum(self, xlo: int, xhi: int, ylo: int, yhi: int) -> int:
+        """Returns the sum of the weights in rows xlo..xhi-1, columns ylo..yhi-1.
+
+        Args:
+        - xlo: the first row of the rectangle.
+        - xhi: one past the last row of the rectangle.
+        - ylo: the first column of the rectangle.
+        - yhi: one past the last column of the rectangle.
+
+        Returns:
+        the sum of the mask weights in the rectangle.
+        """
+        sums = self._sums
+        return sums[xhi][yhi] - sums[xlo][yhi] - sums[xhi][ylo] + sums[xlo][ylo]
+
+
+def load_mask(maskfile: str) -> Mask:
+    """Returns the mask stored in maskfile, parsing it only when needed.
+
+    Parsed masks are kept in a least-recently-used cache keyed by the file's
+    absolute path, inode, modification and change times and size, so
+    repeated loads of an unchanged file cost one stat call, while edited or
+    replaced files are reparsed. A file rewritten in place with content of
+    the same size within one tick of the file system's clock, which on some
+    file systems is a second or two, is not seen to change; write such
+    files elsewhere and rename them over the old ones instead.
+
+    Args:
+    - maskfile: path to a file holding the mask size followed by its
+      weights, one number per line.
+
+    Returns:
+    the parsed mask.
+    """
+    info = os.stat(maskfile)
+    return _parse_mask(os.path.abspath(maskfile), info.st_ino,
+                       info.st_mtime_ns, info.st_ctime_ns, info.st_size)
+
+
+@lru_cache(maxsize=32)
+def _parse_mask(path: str, inode: int, mtime: int, ctime: int,
+                length: int) -> Mask:
+    """Parses the mask file at path; the other arguments only key the cache.
+
+    Args:
+    - path: absolute path of the mask file.
+    - inode: inode number of the file.
+    - mtime: modification time of the file in nanoseconds.
+    - ctime: change time of the file in nanoseconds.
+    - length: size of the file in bytes.
+
+    Returns:
+    the parsed mask.
+    """
+    with open(path, 'r') as mask:
+        size = int(mask.readline())
+        weights = [int(line) for line in mask if line.strip()]
+    return Mask(size, weights)
+
+
+def gray_plane(data, channels: int = 3, keep: tuple = (True,) * 3) -> bytes:
+    """Returns the gray values of the pixels in data, one byte per pixel.
+
+    Suppressed channels count as 0, so a pixel's gray value is the floor of
+    the sum of its kept channels divided by 3. This folds remove_channel into
+    the grayscale conversion.
+
+    Args:
+    - data: the pixel bytes, row by row.
+    - channels: 3 if data holds interleaved RGB values, 1 if it holds gray
+      values standing for pixels with 3 equal channels.
+    - keep: for red, green and blue, whether the channel is kept.
+
+    Returns:
+    the gray plane.
+    """
+    if channels == 1:
+        kept = sum(map(bool, keep))
+        if kept == 3:
+            return bytes(data)
+        if np is not None:
+            plane = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+            return (plane * kept // 3).astype(np.uint8).tobytes()
+        return bytes(v * kept // 3 for v in data)
+    if np is not None:
+        pixels = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        if not all(keep):
+            # a fancy index copies the pixels, so only pay for it when needed
+            pixels = pixels[:, list(map(bool, keep))]
+        plane = pixels.sum(axis=1, dtype=np.uint16)
+        return (plane // 3).astype(np.uint8).tobytes()
+    kept = [data[ch::3] for ch in range(3) if keep[ch]]
+    if not kept:
+        return bytes(len(data) // 3)
+    return bytes(sum(values) // 3 for values in zip(*kept))
+
+
+def _tap_ranges(length: int, size: int) -> list:
+    """Returns, per position along an axis, the in-bounds taps of a mask.
+
+    Args:
+    - length: the number of positions along the axis.
+    - size: the side length of the mask.
+
+    Returns:
+    for each position p, the range (lo, hi) of tap indices t for which
+    p + t - size//2 lies in 0..length-1.
+    """
+    r = size // 2
+    return [(max(0, r - p), min(size, length - p + r)) for p in range(length)]
+
+
+def convolve_python(gray, width: int, height: int, mask: Mask,
+                    average: bool) -> bytes:
+    """Returns the masked grayscale plane of an image, in pure python.
+
+    Taps are clipped to the image per row and column up front, so each
+    output pixel is a handful of slice dot products with no bounds checks,
+    and its denominator is one lookup in the mask's prefix sums.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply.
+    - average: divide each weighted sum by the sum of the weights used.
+
+    Returns:
+    the width*height gray values of the masked image, row by row.
+    """
+    return _sweep_python(gray, width, height, [mask], [average])[0]
+
+
+def _sweep_python(gray, width: int, height: int, masks: list,
+                  averages: list) -> list:
+    """Returns the masked grayscale planes of an image for masks of one size.
+
+    The in-bounds window of every pixel is sliced out of the gray plane
+    once and dotted with each of the masks, see convolve_python.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - masks: the masks to apply; they must all have the same size.
+    - averages: for each mask, whether to divide each weighted sum by the
+      sum of the weights used.
+
+    Returns:
+    for each mask, the width*height gray values of the masked image.
+    """
+    size = masks[0].size
+    r = size // 2
+    spans = _tap_ranges(width, size)
+
+    planes = [bytearray() for mask in masks]
+    for i, (xlo, xhi) in enumerate(_tap_ranges(height, size)):
+        for j, (ylo, yhi) in enumerate(spans):
+            windows = [(x*size, gray[(i+x-r)*width+j-r+ylo:
+                                     (i+x-r)*width+j-r+yhi])
+                       for x in range(xlo, xhi)]
+            for mask, average, plane in zip(masks, averages, planes):
+                weights = mask.weights
+                number = 0
+                for row, window in windows:
+                    number += sum(map(mul, weights[row+ylo:row+yhi], window))
+                if average:
+                    number //= mask.weight_sum(xlo, xhi, ylo, yhi)
+                plane.append(min(max(0, number), 255))
+    return [bytes(plane) for plane in planes]
+
+
+def convolve_separable(gray, width: int, height: int, mask: Mask,
+                       average: bool) -> bytes:
+    """Returns the masked grayscale plane of an image for a separable mask.
+
+    The mask, column x row, is applied as a horizontal pass with row followed
+    by a vertical pass with column, i.e. 2k instead of k*k multiply-adds per
+    pixel for a k x k mask. Out-of-bounds taps are skipped in both passes,
+    and the averaging denominator factors the same way.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply; it must have factors.
+    - average: divide each weighted sum by the sum of the weights used.
+
+    Returns:
+    the width*height gray values of the masked image, row by row.
+    """
+    column, row = mask.factors
+    r = len(row) // 2
+
+    # Horizontal pass, one image row at a time.
+    spans = _tap_ranges(width, len(row))
+    horizontal = []
+    for i in range(height):
+        line = gray[i*width:(i+1)*width]
+        horizontal.append([sum(map(mul, row[lo:hi], line[j+lo-r:j+hi-r]))
+                           for j, (lo, hi) in enumerate(spans)])
+    column_sums = [sum(row[lo:hi]) for lo, hi in spans]
+
+    # Vertical pass, accumulating whole rows of the horizontal result.
+    plane = bytearray()
+    for i, (lo, hi) in enumerate(_tap_ranges(height, len(column))):
+        number = [0] * width
+        for t in range(lo, hi):
+            if column[t]:
+                number = [n + column[t] * v
+                          for n, v in zip(number, horizontal[i + t - r])]
+        if average:
+            row_sum = sum(column[lo:hi])
+            number = [n // (row_sum * s) for n, s in zip(number, column_sums)]
+        plane += bytes(min(max(0, n), 255) for n in number)
+    return bytes(plane)
+
+
+def _box_bounds(length: int, size: int) -> (list, list):
+    """Returns, per position along an axis, the in-bounds pixels under a mask.
+
+    Args:
+    - length: the number of positions along the axis.
+    - size: the side length of the mask.
+
+    Returns:
+    (lows, highs): the pixels under the mask centred on position p are
+    lows[p]..highs[p]-1.
+    """
+    r = size // 2
+    return ([max(0, p - r) for p in range(length)],
+            [min(length, p + r + 1) for p in range(length)])
+
+
+def convolve_box(gray, width: int, height: int, mask: Mask,
+                 average: bool) -> bytes:
+    """Returns the masked grayscale plane of an image for a uniform mask.
+
+    All taps of the mask have the same weight, so the weighted sum under the
+    mask is that weight times the sum of the pixels in a rectangle, read in
+    O(1) from a summed-area table whatever the mask size. Averaging divides
+    the pixel sum by the number of in-bounds pixels, which equals dividing
+    the weighted sum by the sum of the in-bounds weights.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply; it must be uniform.
+    - average: divide each weighted sum by the sum of the weights used.
+
+    Returns:
+    the width*height gray values of the masked image, row by row.
+    """
+    weight = mask.uniform
+    # table[i][j] is the sum of the pixels in rows < i and columns < j.
+    table = [[0] * (width + 1)]
+    for i in range(height):
+        line = accumulate(gray[i*width:(i+1)*width], initial=0)
+        table.append([a + b for a, b in zip(table[-1], line)])
+
+    lefts, rights = _box_bounds(width, mask.size)
+    widths = [right - left for left, right in zip(lefts, rights)]
+    plane = bytearray()
+    for top, bottom in zip(*_box_bounds(height, mask.size)):
+        upper, lower = table[top], table[bottom]
+        sums = [lower[right] - upper[right] - lower[left] + upper[left]
+                for left, right in zip(lefts, rights)]
+        if average:
+            rows = bottom - top
+            number = [s // (rows * w) for s, w in zip(sums, widths)]
+        else:
+            number = [weight * s for s in sums]
+        plane += bytes(min(max(0, n), 255) for n in number)
+    return bytes(plane)
+
+
+def convolve_box_numpy(gray, width: int, height: int, mask: Mask,
+                       average: bool) -> bytes:
+    """Returns the masked grayscale plane of an image for a uniform mask,
+    computed with numpy. See convolve_box.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply; it must be uniform.
+    - average: divide each weighted sum by the sum of the weights used.
+
+    Returns:
+    the width*height gray values of the masked image, row by row.
+    """
+    gray = np.frombuffer(gray, dtype=np.uint8).reshape(height, width)
+    table = np.zeros((height + 1, width + 1), dtype=np.int64)
+    table[1:, 1:] = gray.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+
+    tops, bottoms = map(np.array, _box_bounds(height, mask.size))
+    lefts, rights = map(np.array, _box_bounds(width, mask.size))
+    sums = table[np.ix_(bottoms, rights)] - table[np.ix_(tops, rights)] \
+        - table[np.ix_(bottoms, lefts)] + table[np.ix_(tops, lefts)]
+    if average:
+        number = sums // np.outer(bottoms - tops, rights - lefts)
+    else:
+        number = mask.uniform * sums
+    return np.clip(number, 0, 255).astype(np.uint8).tobytes()
+
+
+def convolve_numpy(gray, width: int, height: int, mask: Mask,
+                   average: bool) -> bytes:
+    """Returns the masked grayscale plane of an image, computed with numpy.
+
+    Borders are handled by zero padding the gray plane; the averaging
+    denominator of every pixel is the sum of the weights of its in-bounds
+    taps, obtained as one matrix product of row and column validity.
+    Separable masks are applied as two 1-D passes.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply.
+    - average: divide each weighted sum by the sum of the weights used.
+
+    Returns:
+    the width*height gray values of the masked image, row by row.
+    """
+    if not mask.factors:
+        return _sweep_numpy(gray, width, height, [mask], [average])[0]
+    size = mask.size
+    padded = _padded_numpy(gray, width, height, size)
+    column, row = mask.factors
+    number = np.zeros((height, width), dtype=np.int64)
+    horizontal = np.zeros((height + size - 1, width), dtype=np.int64)
+    for y in range(size):
+        if row[y]:
+            horizontal += row[y] * padded[:, y:y+width]
+    for x in range(size):
+        if column[x]:
+            number += column[x] * horizontal[x:x+height]
+    return _finish_numpy(number, width, height, mask, average)
+
+
+def _padded_numpy(gray, width: int, height: int, size: int) -> 'np.ndarray':
+    """Returns the gray plane of an image with a border of zeros, so that
+    every tap of a size x size mask falls inside it.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - size: the side length of the mask.
+
+    Returns:
+    a (height + size - 1) x (width + size - 1) array of int64.
+    """
+    r = size // 2
+    padded = np.zeros((height + size - 1, width + size - 1), dtype=np.int64)
+    padded[r:r+height, r:r+width] = \
+        np.frombuffer(gray, dtype=np.uint8).reshape(height, width)
+    return padded
+
+
+def _finish_numpy(number, width: int, height: int, mask: Mask,
+                  average: bool) -> bytes:
+    """Returns the gray plane of weighted sums number, averaged if asked,
+    then clamped.
+
+    Args:
+    - number: the height x width array of weighted sums.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask the sums are weighted by.
+    - average: divide each weighted sum by the sum of the weights used.
+
+    Returns:
+    the width*height gray values, row by row.
+    """
+    if average:
+        kernel = np.asarray(mask.weights, dtype=np.int64)
+        number //= _denominator_numpy(
+            width, height, kernel.reshape(mask.size, mask.size))
+    return np.clip(number, 0, 255).astype(np.uint8).tobytes()
+
+
+def _sweep_numpy(gray, width: int, height: int, masks: list,
+                 averages: list) -> list:
+    """Returns the masked grayscale planes of an image for masks of one
+    size, computed with numpy.
+
+    The image is shifted under each tap position once, and the shifted
+    plane is added, weighted, to the sums of every mask.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - masks: the masks to apply; they must all have the same size.
+    - averages: for each mask, whether to divide each weighted sum by the
+      sum of the weights used.
+
+    Returns:
+    for each mask, the width*height gray values of the masked image.
+    """
+    size = masks[0].size
+    padded = _padded_numpy(gray, width, height, size)
+    numbers = [np.zeros((height, width), dtype=np.int64) for mask in masks]
+    for x in range(size):
+        for y in range(size):
+            shifted = padded[x:x+height, y:y+width]
+            for mask, number in zip(masks, numbers):
+                weight = mask.weights[x*size + y]
+                if weight:
+                    number += weight * shifted
+    return [_finish_numpy(number, width, height, mask, average)
+            for number, mask, average in zip(numbers, masks, averages)]
+
+
+def _denominator_numpy(width: int, height: int, kernel) -> 'np.ndarray':
+    """Returns the averaging denominator of every pixel of an image.
+
+    The denominator of a pixel is the sum of the weights of its in-bounds
+    taps, obtained for all pixels as one matrix product of row and column
+    validity.
+
+    Args:
+    - width: the width of the image.
+    - height: the height of the image.
+    - kernel: the size x size mask weights, as a numpy array.
+
+    Returns:
+    a height x width array of denominators.
+    """
+    size = len(kernel)
+    # rows[i, x] is 1 when tap row x of output row i is in bounds.
+    offsets = np.arange(size) - size // 2
+    rows = np.arange(height)[:, None] + offsets
+    rows = ((rows >= 0) & (rows < height)).astype(np.int64)
+    columns = np.arange(width)[:, None] + offsets
+    columns = ((columns >= 0) & (columns < width)).astype(np.int64)
+    denominator = rows @ kernel @ columns.T
+    if not denominator.all():
+        raise ZeroDivisionError('mask weights under a pixel sum to zero')
+    return denominator
+
+
+def _fast_length(n: int) -> int:
+    """Returns the least m >= n with no prime factors other than 2, 3 and 5.
+
+    Args:
+    - n: the least length wanted.
+
+    Returns:
+    the length, for which FFTs are fast.
+    """
+    best = 1 << max(0, (n - 1).bit_length())
+    fives = 1
+    while fives < best:
+        threes = fives
+        while threes < best:
+            m = threes
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            threes *= 3
+        fives *= 5
+    return best
+
+
+def convolve_fft(gray, width: int, height: int, mask: Mask,
+                 average: bool) -> bytes:
+    """Returns the masked grayscale plane of an image, computed by FFT.
+
+    The weighted sums are the correlation of the zero padded gray plane with
+    the mask, computed as a product of 2-D FFTs in O(log(n)) per pixel
+    whatever the mask size. Every weighted sum is an integer far below 2**52
+    in magnitude, so rounding the floating point result recovers it exactly;
+    averaging, flooring and clamping then proceed on integers as in the
+    other engines.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply.
+    - average: divide each weighted sum by the sum of the weights used.
+
+    Returns:
+    the width*height gray values of the masked image, row by row.
+    """
+    return _sweep_fft(gray, width, height, [mask], [average])[0]
+
+
+def _sweep_fft(gray, width: int, height: int, masks: list,
+               averages: list) -> list:
+    """Returns the masked grayscale planes of an image for masks of one
+    size, computed by FFT.
+
+    The spectrum of the image is computed once and multiplied by that of
+    each mask, see convolve_fft.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - masks: the masks to apply; they must all have the same size.
+    - averages: for each mask, whether to divide each weighted sum by the
+      sum of the weights used.
+
+    Returns:
+    for each mask, the width*height gray values of the masked image.
+    """
+    size = masks[0].size
+    gray = np.frombuffer(gray, dtype=np.uint8).reshape(height, width)
+    shape = (_fast_length(height + size - 1), _fast_length(width + size - 1))
+    spectrum = np.fft.rfft2(gray, shape)
+    # Convolving with the flipped kernel correlates with the kernel; the sum
+    # for pixel (i, j) lands at (i + offset, j + offset) of the full result.
+    offset = size - 1 - size // 2
+
+    planes = []
+    for mask, average in zip(masks, averages):
+        kernel = np.asarray(mask.weights, dtype=np.int64).reshape(size, size)
+        full = np.fft.irfft2(spectrum * np.fft.rfft2(kernel[::-1, ::-1],
+                                                     shape), shape)
+        number = np.rint(full[offset:offset+height, offset:offset+width])
+        planes.append(_finish_numpy(number.astype(np.int64), width, height,
+                                    mask, average))
+    return planes
+
+
+def fft_min_size() -> int:
+    """Returns the least mask size for which convolve_fft is the faster
+    numpy engine, measuring it on the first call unless FFT_MIN_SIZE is set.
+
+    Both engines are timed on a random image with random masks of growing
+    size, until convolve_fft beats convolve_numpy.
+
+    Args:
+
+    Returns:
+    the mask size.
+    """
+    global FFT_MIN_SIZE
+    if FFT_MIN_SIZE is None:
+        rng = np.random.default_rng(0)
+        gray = rng.integers(0, 256, _TUNE_SIDE**2, dtype=np.uint8).tobytes()
+        FFT_MIN_SIZE = _TUNE_SIZES[-1] + 2
+        for size in _TUNE_SIZES:
+            mask = Mask(size, rng.integers(1, 10, size * size).tolist())
+            seconds = []
+            for engine in (convolve_numpy, convolve_fft):
+                start = perf_counter()
+                for i in range(3):
+                    engine(gray, _TUNE_SIDE, _TUNE_SIDE, mask, True)
+                seconds.append(perf_counter() - start)
+            if seconds[1] < seconds[0]:
+                FFT_MIN_SIZE = size
+                break
+    return FFT_MIN_SIZE
+
+
+def _numpy_engine(mask: Mask) -> str:
+    """Returns 'fft' if the numpy engine should apply mask by FFT, else
+    'numpy'.
+
+    Args:
+    - mask: the mask to apply.
+
+    Returns:
+    the engine name.
+    """
+    if mask.uniform is None and not mask.factors and \
+            mask.size >= fft_min_size():
+        return 'fft'
+    return 'numpy'
+
+
+def convolve(gray, width: int, height: int, mask: Mask, average: bool,
+             engine: str = 'python') -> bytes:
+    """Returns the masked grayscale plane of an image using the given engine.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply.
+    - average: divide each weighted sum by the sum of the weights used.
+    - engine: 'numpy', 'python' or 'fft'. Large masks that are neither
+      separable nor uniform are applied by FFT under 'numpy' too, see
+      fft_min_size.
+
+    Returns:
+    the width*height gray values of the masked image, row by row.
+    """
+    if engine == 'fft':
+        return convolve_fft(gray, width, height, mask, average)
+    if mask.uniform is not None and width and height:
+        if engine == 'numpy':
+            return convolve_box_numpy(gray, width, height, mask, average)
+        return convolve_box(gray, width, height, mask, average)
+    if engine == 'numpy':
+        if _numpy_engine(mask) == 'fft':
+            return convolve_fft(gray, width, height, mask, average)
+        return convolve_numpy(gray, width, height, mask, average)
+    if mask.factors:
+        return convolve_separable(gray, width, height, mask, average)
+    return convolve_python(gray, width, height, mask, average)
+
+
+def convolve_many(gray, width: int, height: int, masks: list, averages: list,
+                  engine: str = 'python') -> list:
+    """Returns the masked grayscale planes of an image for several masks.
+
+    Masks applied by the direct or FFT engines are grouped by size, and
+    each group is applied in one sweep over the image: the window under
+    every pixel, or the spectrum of the image, is computed once for all
+    masks of the group. Separable and uniform masks, whose engines do not
+    revisit windows, are applied one by one.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - masks: the masks to apply.
+    - averages: for each mask, whether to divide each weighted sum by the
+      sum of the weights used.
+    - engine: 'numpy', 'python' or 'fft', as for convolve.
+
+    Returns:
+    for each mask, the width*height gray values of the masked image.
+    """
+    sweeps = {'python': _sweep_python, 'fft': _sweep_fft}
+    if np is not None:
+        sweeps['numpy'] = _sweep_numpy
+    planes = [None] * len(masks)
+    # (engine, mask size) -> indices of the masks to sweep together
+    groups = {}
+    for n, mask in enumerate(masks):
+        kind = engine
+        if engine != 'fft':
+            if mask.uniform is not None or mask.factors or not width \
+                    or not height:
+                kind = None
+            elif engine == 'numpy':
+                kind = _numpy_engine(mask)
+        if kind is None:
+            planes[n] = convolve(gray, width, height, mask, averages[n],
+                                 engine)
+        else:
+            groups.setdefault((kind, mask.size), []).append(n)
+    for (kind, size), group in groups.items():
+        swept = sweeps[kind](gray, width, height, [masks[n] for n in group],
+                             [averages[n] for n in group])
+        for n, plane in zip(group, swept):
+            planes[n] = plane
+    return planes
+
+
+def _band_rows(height: int, count: int) -> list:
+    """Returns the rows splitting an image into bands of similar heights.
+
+    Args:
+    - height: the height of the image.
+    - count: the number of bands.
+
+    Returns:
+    count + 1 rows: band k holds the rows from the k-th up to the next one.
+    """
+    return [height * k // count for k in range(count + 1)]
+
+
+def _halo(first: int, last: int, height: int, size: int) -> (int, int):
+    """Returns the rows a band must be read with to be masked on its own.
+
+    The band is grown by size//2 rows on either side, clipped to the image,
+    so every tap of the band's rows sees exactly the pixels it would see in
+    the whole image.
+
+    Args:
+    - first: the first row of the band.
+    - last: one past the last row of the band.
+    - height: the height of the image.
+    - size: the side length of the mask.
+
+    Returns:
+    (top, bottom): the first row to read and one past the last.
+    """
+    return max(0, first - size//2), min(height, last + size//2)
+
+
+def _convolve_band(source: str, target: str, width: int, height: int,
+                   first: int, last: int, *args) -> None:
+    """Masks rows first..last-1 of a shared image into a shared plane.
+
+    Runs in a worker process. The band is read together with its halo, see
+    _halo.
+
+    Args:
+    - source: name of the shared memory block holding the gray plane.
+    - target: name of the shared memory block receiving the gray plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - first: the first row of the band.
+    - last: one past the last row of the band.
+    - args: mask, average and engine, as for convolve.
+
+    Returns:
+    none
+    """
+    top, bottom = _halo(first, last, height, args[0].size)
+    gray, plane = SharedMemory(source), SharedMemory(target)
+    try:
+        # A private copy of the band keeps the engines from holding exports
+        # of the shared buffer, which would stop it from being closed.
+        band = bytes(gray.buf[width*top:width*bottom])
+        masked = convolve(band, width, bottom - top, *args)
+        plane.buf[width*first:width*last] = \
+            masked[width*(first-top):width*(last-top)]
+    finally:
+        gray.close()
+        plane.close()
+
+
+def convolve_parallel(gray, width: int, height: int, mask: Mask, average: bool,
+                      engine: str = 'python', workers: int = 2) -> bytes:
+    """Returns the masked grayscale plane of an image using worker processes.
+
+    The image is split into one horizontal band of rows per worker. Workers
+    read the gray plane from, and write their rows of the result to, shared
+    memory, so pixels are never pickled. The result is identical to that of
+    convolve.
+
+    Args:
+    - gray: the gray plane of the image, see gray_plane.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply.
+    - average: divide each weighted sum by the sum of the weights used.
+    - engine: 'numpy', 'python' or 'fft', the engine run by each worker.
+    - workers: the number of worker processes.
+
+    Returns:
+    the width*height gray values of the masked image, row by row.
+    """
+    workers = min(workers, height)
+    if workers < 2 or width == 0:
+        return convolve(gray, width, height, mask, average, engine)
+    if engine == 'numpy':
+        # choose between numpy and FFT here, once, not in every worker
+        engine = _numpy_engine(mask)
+    source = SharedMemory(create=True, size=len(gray))
+    target = SharedMemory(create=True, size=width * height)
+    try:
+        source.buf[:len(gray)] = gray
+        rows = _band_rows(height, workers)
+        with ProcessPoolExecutor(workers) as pool:
+            bands = [pool.submit(_convolve_band, source.name, target.name,
+                                 width, height, first, last, mask, average,
+                                 engine)
+                     for first, last in zip(rows, rows[1:])]
+            for band in bands:
+                band.result()
+        return bytes(target.buf[:width * height])
+    finally:
+        source.close()
+        source.unlink()
+        target.close()
+        target.unlink()
+
+
+def convolve_banded(read, write, width: int, height: int, mask: Mask,
+                    average: bool, engine: str = 'python',
+                    band: int = None) -> None:
+    """Masks an image one band of rows at a time.
+
+    Only a band, its halo (see _halo) and the engine's work on them are in
+    memory at once, so images mapped from files larger than memory can be
+    masked. The result is identical to that of convolve.
+
+    Args:
+    - read: function of (top, bottom) returning the gray plane of rows
+      top..bottom-1 of the image, see gray_plane.
+    - write: function of (first, last, plane) storing plane, the masked gray
+      values of rows first..last-1.
+    - width: the width of the image.
+    - height: the height of the image.
+    - mask: the mask to apply.
+    - average: divide each weighted sum by the sum of the weights used.
+    - engine: 'numpy', 'python' or 'fft', see convolve.
+    - band: about how many pixels to mask at a time; BAND_PIXELS by default.
+
+    Returns:
+    none
+    """
+    rows = max(1, (BAND_PIXELS if band is None else band) // max(1, width))
+    for first in range(0, height, rows):
+        last = min(height, first + rows)
+        top, bottom = _halo(first, last, height, mask.size)
+        masked = convolve(read(top, bottom), width, bottom - top, mask,
+                          average, engine)
+        write(first, last, masked[width*(first-top):width*(last-top)])
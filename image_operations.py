@@ -1,24 +1,52 @@
 from PIL import Image
 from APL import *
 import array as arr
+import convolution
+import struct
+
+# header of raw image files: magic, width, height and channel layout
+HEADER = struct.Struct('<4sII4s')
+MAGIC = b'MYIM'
+# file name extension of raw image files
+RAW_EXTENSION = '.raw'
 
 class MyImage:
     """ Holds a flattened RGB image and its dimensions.
     """
-    def __init__(self, size: (int, int), pointer=False) -> None:
+    def __init__(self, size: (int, int), pointer=False, pixels=None) -> None:
         """Initializes a black image of the given size.
         Args:
         - size: (width, height) specifies the dimensions to create.
+        - pointer: if True then the backing list is pointer-based else array-based.
+        - pixels: optional backing list of width*height pixels to adopt
+          instead of allocating a black one.
         Returns:
         none
         """
         self.pointer = pointer
         width, height = self.size = size
-        if pointer:
+        if pixels is not None:
+            assert len(pixels) == width * height, f'{len(pixels)} pixels '\
+                f'do not fill an image of size: {size}'
+            self.pixels = pixels
+        elif pointer:
             self.pixels: PointerList = PointerList(
                 width * height, value=(0, 0, 0))
         else:
             self.pixels: ArrayList = ArrayList(width * height, value=(0, 0, 0))
+        # number of images sharing pixels, held in a list shared by them all
+        self._sharers = [1]
+        # cached gray plane, see gray(); None when not computed or stale
+        self._gray = None
+        # the version of pixels the cached gray plane was computed from
+        self._gray_version = None
+        # rows of which writable views were handed out: writes through them
+        # cannot be seen, so the gray plane is not cached and the rows are
+        # always dirty
+        self._viewed = set()
+        # (r0, c0, r1, c1) rectangles written since the last take_dirty(),
+        # or None until take_dirty() is first called
+        self._dirty = None
     def _get_index(self, r: int, c: int) -> int:
         """Returns the list index for the given row, column coordinates.
         This is an internal function for use in class methods only. It should
@@ -37,23 +65,45 @@ class MyImage:
     def open(path, pointer=False):
         """Creates and returns an image containing from the information at file path.
         The image format is inferred from the file name. The read image is
-        converted to RGB as our type only stores RGB.
+        converted to RGB as our type only stores RGB. Files ending in
+        RAW_EXTENSION hold a header and the raw pixels, as written by save;
+        they are read straight into the image, and can also be mapped
+        without copying by MyImage.mapped.
         Args:
         - path: path to the file containing image information
         Returns:
         the image created using the information from file path.
         """
-        # Use PIL to read the image information and store it in our instance.
-        img: PIL.Image = Image.open(path)
-        myimg: MyImage = MyImage(img.size, pointer)
-        width, height = img.size
-        # Covert image to RGB. https://stackoverflow.com/a/11064935/1382487
-        img: PIL.Image = img.convert('RGB')
-        # Get list of pixel values (https://stackoverflow.com/a/1109747/1382487),
-        # copy to our instance and return it.
-        for i, rgb in enumerate(list(img.getdata())):
-            myimg.pixels.set(i, rgb)
-        return myimg
+        if str(path).lower().endswith(RAW_EXTENSION):
+            return _open_raw(path, pointer)
+        img: PIL.Image = _decode(path)
+        # Move the raw RGB bytes into our instance in one step and return it.
+        return _image_from_bytes(img.size, pointer, img.tobytes())
+    def mapped(path, size=None, readonly=False):
+        """Creates and returns an image whose pixels are memory-mapped from path.
+        The file holds a header followed by the raw RGB bytes of the image.
+        Only the pages of the file that are touched are read into memory, so
+        the image can be larger than memory. Writes to the image go to the
+        file; call img.pixels.close() to flush and unmap it.
+        Args:
+        - path: path to the file
+        - size: (width, height); if given then a black image of this size is
+          created at path, else the image already at path is mapped.
+        - readonly: if True then the image cannot be written to.
+        Returns:
+        the image mapped from path.
+        """
+        if size is None:
+            with open(path, 'rb') as f:
+                size = _read_header(f, path)
+        else:
+            width, height = size
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, width, height, b'RGB'))
+                # the pixels start as a hole in the file, read back as 0
+                f.truncate(HEADER.size + 3 * width * height)
+        pixels = MappedList(path, size[0] * size[1], HEADER.size, readonly)
+        return MyImage(size, False, pixels)
     def save(self, path: str) -> None:
         """Saves the image to the given file path.
         The image format is inferred from the file name.
@@ -62,10 +112,14 @@ class MyImage:
         Returns:
         none
         """
+        if str(path).lower().endswith(RAW_EXTENSION):
+            # Write the header and the pixels without encoding them.
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, *self.size, b'RGB'))
+                f.write(_pixel_bytes(self))
+            return
         # Use PIL to write the image.
-        img: PIL.Image = Image.new("RGB", self.size)
-        img.putdata([rgb for rgb in self.pixels])
-        img.save(path)
+        self._to_pil().save(path)
     def get(self, r: int, c: int) -> (int, int, int):
         """Returns the value of the pixel at the given row and column coordinates.
         Args:
@@ -84,7 +138,174 @@ class MyImage:
         Returns:
         none
         """
-        self.pixels[self._get_index(r, c)] = rgb
+        i = self._get_index(r, c)
+        self._own(r, c, r + 1, c + 1)
+        self.pixels[i] = rgb
+    def _get_unchecked(self, r: int, c: int) -> (int, int, int):
+        """Returns the value of the pixel at the given coordinates unchecked.
+        This is an internal function for callers that have checked the
+        coordinates against the size of the image already.
+        Args:
+        - r: the row coordinate
+        - c: the column coordinate
+        Returns:
+        the stored RGB value of the pixel at the given row and column coordinates.
+        """
+        return self.pixels._get_unchecked(r*self.size[0] + c)
+    def _set_unchecked(self, r: int, c: int, rgb: (int, int, int)) -> None:
+        """Write the rgb value at the pixel at the given coordinates unchecked.
+        This is an internal function for callers that have checked the
+        coordinates already, and that have called _own() before writing.
+        Args:
+        - r: the row coordinate
+        - c: the column coordinate
+        - rgb: the rgb value to write
+        Returns:
+        none
+        """
+        self.pixels._set_unchecked(r*self.size[0] + c, rgb)
+    def copy(self) -> 'MyImage':
+        """Returns a copy of the image that shares its pixels until written.
+        The pixels are copied by whichever image is written first, through
+        set or a writable row or region view. The pixels are copied at once
+        if writable views of the image have been taken, which keep writing
+        to its pixels, or if they are mapped from a file, so that writes to
+        the image keep going to the file.
+        Args:
+        Returns:
+        the copy.
+        """
+        if self._viewed or isinstance(self.pixels, MappedList):
+            return MyImage(self.size, self.pointer, self.pixels.copy())
+        img = MyImage(self.size, self.pointer, self.pixels)
+        img._sharers = self._sharers
+        img._gray, img._gray_version = self._gray, self._gray_version
+        self._sharers[0] += 1
+        return img
+    def gray(self) -> memoryview:
+        """Returns the gray value of every pixel, computed once and cached.
+        A pixel's gray value is the floor of the mean of its 3 channels.
+        The cache is recomputed after writes through set or through the
+        methods of pixels. It is not kept once a writable row or region view
+        has been taken, nor for images mapped from files, which may not fit
+        in memory. Writes through pixels.view() are not seen; take writable
+        views with row or region instead.
+        Args:
+        Returns:
+        a read-only view of width*height gray values, row by row, over a
+        byte array.
+        """
+        version = self.pixels.version
+        if self._gray is not None and self._gray_version == version:
+            return self._gray
+        gray = arr.array('B')
+        gray.frombytes(convolution.gray_plane(_pixel_bytes(self)))
+        gray = memoryview(gray).toreadonly()
+        if not self._viewed and not isinstance(self.pixels, MappedList):
+            self._gray, self._gray_version = gray, version
+        return gray
+    def take_dirty(self) -> list:
+        """Returns the rectangles of pixels written since the last call.
+        Changes are tracked from the first call on, which returns the whole
+        image. Writes through set mark their pixel, and operations writing to
+        the image mark all of it. Writes through views cannot be seen, so
+        every row of which a writable view was ever taken is returned by
+        every call.
+        Args:
+        Returns:
+        a list of (r0, c0, r1, c1) rectangles: rows r0..r1-1 and columns
+        c0..c1-1. They may overlap.
+        """
+        width, height = self.size
+        if self._dirty is None:
+            dirty = [(0, 0, height, width)]
+        else:
+            dirty = self._dirty + [(r0, 0, r1, width)
+                                   for r0, r1 in _row_runs(self._viewed)]
+        self._dirty = []
+        return dirty
+    def _own(self, r0: int = 0, c0: int = 0, r1: int = None,
+             c1: int = None) -> None:
+        """Prepares the pixels to be written: copies them if they are shared,
+        drops the cached gray plane and marks the rectangle to be written as
+        dirty. The rectangle defaults to the whole image.
+        This is an internal function for use in class methods only.
+        Args:
+        - r0, c0: the top left corner of the rectangle to be written.
+        - r1, c1: one past its bottom right corner.
+        Returns:
+        none
+        """
+        self._gray = None
+        if self._dirty is not None:
+            width, height = self.size
+            self._mark_dirty(r0, c0, height if r1 is None else r1,
+                             width if c1 is None else c1)
+        if self._sharers[0] > 1:
+            self._sharers[0] -= 1
+            self._sharers = [1]
+            self.pixels = self.pixels.copy()
+    def _mark_dirty(self, r0: int, c0: int, r1: int, c1: int) -> None:
+        """Adds a rectangle to the dirty ones, see take_dirty.
+        A rectangle touching the last one added is merged into it, as long
+        as their bounding box is not much larger than both, so that the
+        pixels of a brush stroke make up a few rectangles.
+        This is an internal function for use in class methods only.
+        Args:
+        - r0, c0: the top left corner of the rectangle.
+        - r1, c1: one past its bottom right corner.
+        Returns:
+        none
+        """
+        if self._dirty:
+            a0, b0, a1, b1 = self._dirty[-1]
+            if r0 <= a1 and a0 <= r1 and c0 <= b1 and b0 <= c1:
+                box = (min(r0, a0), min(c0, b0), max(r1, a1), max(c1, b1))
+                area = (box[2] - box[0]) * (box[3] - box[1])
+                if area <= 2 * ((a1 - a0) * (b1 - b0) + (r1 - r0) * (c1 - c0)):
+                    self._dirty[-1] = box
+                    return
+        self._dirty.append((r0, c0, r1, c1))
+    def row(self, r: int, readonly: bool = False) -> memoryview:
+        """Returns a view of the pixels in row r without copying them.
+        The view holds 3 bytes per pixel in RGB order; writing to it writes
+        to the image. Only array-based images can be viewed.
+        Args:
+        - r: the row coordinate
+        - readonly: if True then the returned view cannot be written to.
+        Returns:
+        a memoryview over the 3*width channel bytes of row r.
+        """
+        width, height = self.size
+        assert not self.pointer, 'Views need an array-based image'
+        assert 0 <= r < height, "Bad image row: "\
+            f"{r} for image of size: {self.size}"
+        if not readonly:
+            self._own(r, 0, r + 1, width)
+            self._viewed.add(r)
+        view = self.pixels.view()[3*r*width:3*(r+1)*width]
+        return view.toreadonly() if readonly else view
+    def region(self, r0: int, c0: int, h: int, w: int,
+               readonly: bool = False) -> list:
+        """Returns views of the pixels in a rectangle without copying them.
+        Rows of a rectangle are not contiguous in the flattened image, so
+        the rectangle is returned as one view per row, each holding 3 bytes
+        per pixel in RGB order.
+        Args:
+        - r0: the row coordinate of the top left corner
+        - c0: the column coordinate of the top left corner
+        - h: the height of the rectangle
+        - w: the width of the rectangle
+        - readonly: if True then the returned views cannot be written to.
+        Returns:
+        a list of h memoryviews, each over the 3*w channel bytes of a row.
+        """
+        width, height = self.size
+        assert 0 <= r0 and 0 <= h and r0 + h <= height and \
+            0 <= c0 and 0 <= w and c0 + w <= width, "Bad image region: "\
+            f"({r0}, {c0}, {h}, {w}) for image of size: {self.size}"
+        return [self.row(r, readonly)[3*c0:3*(c0+w)]
+                for r in range(r0, r0 + h)]
     def show(self) -> None:
         """Display the image in a GUI window.
         Args:
@@ -92,53 +313,54 @@ class MyImage:
         none
         """
         # Use PIL to display the image.
-        img: PIL.Image = Image.new("RGB", self.size)
-        img.putdata([rgb for rgb in self.pixels])
-        img.show()
+        self._to_pil().show()
+    def _to_pil(self) -> 'PIL.Image':
+        """Returns a PIL image holding a copy of this image's pixels.
+        This is an internal function for use in class methods only.
+        Args:
+        Returns:
+        an RGB PIL image built from the raw bytes of the backing list.
+        """
+        return Image.frombytes("RGB", self.size, self.pixels.tobytes())
 
 def remove_channel(src: MyImage, red: bool = False, green: bool = False,
-                   blue: bool = False) -> MyImage:
+                   blue: bool = False, inplace: bool = False) -> MyImage:
     """Returns a copy of src in which the indicated channels are suppressed.
 
-    Suppresses the red channel if no channel is indicated. src is not modified.
+    Suppresses the red channel if no channel is indicated. src is not
+    modified unless inplace is True.
+
+    Each suppressed channel of an array-based image is zeroed by a single
+    strided assignment to the backing buffer.
 
     Args:
     - src: the image whose copy the indicated channels have to be suppressed.
     - red: suppress the red channel if this is True.
     - green: suppress the green channel if this is True.
     - blue: suppress the blue channel if this is True.
+    - inplace: suppress the channels in src itself and return it.
 
     Returns:
-    a copy of src with the indicated channels suppressed.
+    a copy of src, or src if inplace, with the indicated channels suppressed.
     """
-    WT, HT = src.size
-
-    # photo will store the resultant image in this case
-    photo = src
-
-    for j in range(HT):
-        for i in range(WT):
-            temp_t_tuple = photo.get(j, i)
-
-            # red color suppressed if red is true
-            if red:
-                temp_t_tuple = (0,) + (temp_t_tuple[1],) + (temp_t_tuple[2],)
+    # default condition implemented (red channel suppressed)
+    if not (red or green or blue):
+        red = True
 
-            # green color suppressed if green is true
-            if green:
-                temp_t_tuple = (temp_t_tuple[0],) + (0,) + (temp_t_tuple[2],)
+    photo = src if inplace else src.copy()
+    photo._own()
 
-            # blue color suppressed if blue is true
-            if blue:
-                temp_t_tuple = (temp_t_tuple[0],) + (temp_t_tuple[1],) + (0,)
+    # pointer-based images are zeroed in a bytes copy of their pixels
+    pixels = bytearray(photo.pixels.tobytes()) if photo.pointer \
+        else photo.pixels.view()
+    zeros = bytes(len(pixels) // 3)
+    for ch, suppress in enumerate((red, green, blue)):
+        if suppress:
+            pixels[ch::3] = zeros
+    if photo.pointer:
+        photo.pixels.frombytes(pixels)
 
-            # default condition implemented (red channel suppressed)
-            if red == False and blue == False and green == False:
-                temp_t_tuple = (0,) + (temp_t_tuple[1],) + (temp_t_tuple[2],)
-
-            photo.set(j, i, temp_t_tuple)
-
-    return photo     
+    return photo
 
 
 # def remove_channel(src: MyImage, red: bool = False, green: bool = False,
@@ -174,73 +396,212 @@ def remove_channel(src: MyImage, red: bool = False, green: bool = False,
 #             img.set(j, i, temp_tuple)
 #     return img
 
-def rotations(src: MyImage) -> MyImage:
+def _decode(path: str) -> 'PIL.Image':
+    """Reads and decodes the image file at path with PIL.
+
+    Args:
+    - path: path to the image file.
+
+    Returns:
+    the decoded image, converted to RGB as our type only stores RGB.
+    """
+    # Covert image to RGB. https://stackoverflow.com/a/11064935/1382487
+    return Image.open(path).convert('RGB')
+
+def _read_header(f, path: str) -> (int, int):
+    """Reads the header of a raw image file.
+
+    Args:
+    - f: the file, opened for binary reading and positioned at its start.
+    - path: path to the file, for error messages.
+
+    Returns:
+    (width, height) of the image in the file.
+    """
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a raw image file')
+    magic, width, height, layout = HEADER.unpack(header)
+    if layout.rstrip(b'\0') != b'RGB':
+        raise ValueError(f'Unsupported channel layout {layout} in {path}')
+    return width, height
+
+
+def _open_raw(path: str, pointer: bool = False) -> MyImage:
+    """Reads a raw image file into a new image, see MyImage.open.
+
+    Args:
+    - path: path to the file.
+    - pointer: if True then the backing list is pointer-based else array-based.
+
+    Returns:
+    the image in the file.
+    """
+    with open(path, 'rb') as f:
+        size = _read_header(f, path)
+        length = 3 * size[0] * size[1]
+        if pointer:
+            data = f.read(length)
+            read = len(data)
+        else:
+            img = MyImage(size)
+            read = f.readinto(img.pixels.view())
+    if read != length:
+        raise ValueError(f'{path} is truncated: {read} of {length} bytes')
+    return _image_from_bytes(size, True, data) if pointer else img
+
+
+def _result_image(size: (int, int), out: MyImage = None) -> MyImage:
+    """Returns the array-based image an operation writes its result to.
+
+    Args:
+    - size: (width, height) of the result.
+    - out: optional image to write to, e.g. a memory-mapped one.
+
+    Returns:
+    out, or a new black image if out is None.
+    """
+    if out is None:
+        return MyImage(size)
+    assert out.size == size and not out.pointer, f'Cannot write result of '\
+        f'size {size} to {"pointer-based " if out.pointer else ""}image of '\
+        f'size {out.size}'
+    out._own()
+    return out
+
+
+def rotations(src: MyImage, out: MyImage = None) -> MyImage:
     """Returns an image containing the 4 rotations of src.
 
     The new image has twice the dimensions of src. src is not modified.
 
+    Each quadrant is filled straight from src: every row of a quadrant is a
+    row or a column of src, read forwards or backwards, so it is copied as
+    one strided slice per channel without any intermediate images.
+
     Args:
-    - src: the image whose rotations have to be stored and returned.
+    - src: the (square) image whose rotations have to be stored and returned.
+    - out: optional array-based image, twice the size of src, to store the
+      rotations in instead of a new image.
 
     Returns:
     an image twice the size of src and containing the 4 rotations of src.
     """
     WT, HT = src.size
+    assert WT == HT, f'Cannot rotate non-square image of size: {src.size}'
 
-    photo = src
+    # array-based images are written in place, pointer-based ones through
+    # a bytes copy of their pixels
+    if src.pointer and out is None:
+        result = bytearray(3 * WT*2 * HT*2)
+    else:
+        # image that will store the resultant image
+        result_photo = _result_image((WT*2, HT*2), out)
+        result = result_photo.pixels.view()
 
-    # two temporary images instantiated for use in between rotations
-    temp_img = MyImage((WT, HT), src.pointer)
-    temp_img2 = MyImage((WT, HT), src.pointer)
+    _rotate_into(_pixel_bytes(src), 3, WT, result)
 
-    # new image instantiated that will store the resultant image
-    result_photo = MyImage((WT*2, HT*2), src.pointer)
+    if src.pointer and out is None:
+        result_photo = _image_from_bytes((WT*2, HT*2), True, result)
 
-    # rotate once (top left image)
-    for j in range(HT):
-        for i in range(WT):
-            temp_t_tuple = photo.get(j, i)
+    return result_photo
 
-            x_axis = HT - 1 - i
-            y_axis = j
 
-            temp_img.set(x_axis, y_axis, temp_t_tuple)
-            result_photo.set(x_axis, y_axis, temp_t_tuple)
+def _row_runs(rows) -> list:
+    """Returns the runs of consecutive rows in a collection of rows.
 
-    # rotate twice (bottom left image)
-    for j in range(HT):
-        for i in range(WT):
-            temp_t_tuple = temp_img.get(j, i)
+    Args:
+    - rows: the row coordinates, in any order.
 
-            x_axis = HT - 1 - i
-            y_axis = j
+    Returns:
+    (r0, r1) for each run of rows r0..r1-1, in order.
+    """
+    runs = []
+    for r in sorted(rows):
+        if runs and runs[-1][1] == r:
+            runs[-1] = (runs[-1][0], r + 1)
+        else:
+            runs.append((r, r + 1))
+    return runs
 
-            temp_img2.set(x_axis, y_axis, temp_t_tuple)
-            result_photo.set(x_axis+HT, y_axis, temp_t_tuple)
 
-    # rotate thrice (bottom right image)
-    for j in range(HT):
-        for i in range(WT):
-            temp_t_tuple = temp_img2.get(j, i)
+def _pixel_bytes(src: MyImage):
+    """Returns the RGB bytes of src, without copying them if possible.
 
-            x_axis = HT - 1 - i
-            y_axis = j
+    Args:
+    - src: the image whose pixels are wanted.
 
-            temp_img.set(x_axis, y_axis, temp_t_tuple)
-            result_photo.set(x_axis+HT, y_axis+WT, temp_t_tuple)
+    Returns:
+    a view of the buffer of an array-based image, or a bytes copy of the
+    pixels of a pointer-based one.
+    """
+    return src.pixels.tobytes() if src.pointer else src.pixels.view()
 
-    # rotate fourth time (top right image or original image)
-    for j in range(HT):
-        for i in range(WT):
-            temp_t_tuple = temp_img.get(j, i)
 
-            x_axis = HT - 1 - i
-            y_axis = j
+def _image_from_bytes(size: (int, int), pointer: bool, rgb) -> MyImage:
+    """Returns an image of the given size holding the RGB bytes rgb.
 
-            temp_img2.set(x_axis, y_axis, temp_t_tuple)
-            result_photo.set(x_axis, y_axis+WT, temp_t_tuple)
+    Args:
+    - size: (width, height) of the image.
+    - pointer: if True then the backing list is pointer-based else array-based.
+    - rgb: the interleaved RGB bytes of the image, row by row.
 
-    return result_photo
+    Returns:
+    the image.
+    """
+    if pointer:
+        pixels = zip(rgb[0::3], rgb[1::3], rgb[2::3])
+        return MyImage(size, True, PointerList.from_iterable(pixels))
+    img = MyImage(size)
+    img.pixels.frombytes(rgb)
+    return img
+
+
+def _rotate_into(source, channels: int, n: int, target,
+                 target_channels: int = 3, keep: tuple = (True,) * 3) -> None:
+    """Writes the 4 rotations of an n x n image into a 2n x 2n buffer.
+
+    Every row of a quadrant of the result is a row or a column of source,
+    read forwards or backwards, and is copied as one strided slice per
+    channel.
+
+    Args:
+    - source: the pixel bytes of the image, row by row.
+    - channels: bytes per pixel in source; 1 for gray values standing for
+      3 equal channels, 3 for RGB.
+    - n: the width and height of the image.
+    - target: zero-filled buffer receiving the rotations, row by row.
+    - target_channels: bytes per pixel in target, 1 or 3.
+    - keep: for each target channel, whether to write it or leave it 0.
+
+    Returns:
+    none
+    """
+    row = channels * n                   # bytes in a row of source
+    half = target_channels * n           # bytes in half a row of target
+    for j in range(n):
+        top = j * 2 * half
+        bottom = (j + n) * 2 * half
+        for ch in range(target_channels):
+            if not keep[ch]:
+                continue
+            s = min(ch, channels - 1)    # source channel for target channel
+            t = target_channels
+
+            # rotate once (top left image): column n-1-j of src, downwards
+            target[top+ch:top+half:t] = source[channels*(n-1-j)+s::row]
+
+            # rotate twice (bottom left image): row n-1-j of src, reversed
+            target[bottom+ch:bottom+half:t] = \
+                source[(n-1-j)*row+s:(n-j)*row:channels][::-1]
+
+            # rotate thrice (bottom right image): column j of src, upwards
+            target[bottom+half+ch:bottom+2*half:t] = \
+                source[channels*j+s::row][::-1]
+
+            # rotate fourth time (top right image or original image)
+            target[top+half+ch:top+2*half:t] = \
+                source[j*row+s:(j+1)*row:channels]
 
 # def rotations(src: MyImage) -> MyImage:
 #     """Returns an image containing the 4 rotations of src.
@@ -291,40 +652,382 @@ def rotations(src: MyImage) -> MyImage:
 #             result_img.set(new_row, new_column+width, temp_tuple)
 #     return result_img
 
-def apply_mask(src: MyImage, maskfile: str, average: bool = True) -> MyImage:
-    
-    newImage = MyImage(src.size)
-    x_axis,y_axis=src.size
-    mask=open(maskfile,'r')
-    matrix=[]
-    denominator=0
-    mask_size=int(mask.readline())
-    
-    mask_lines=mask.readlines()
-    for i in range(0,len(mask_lines)):
-        matrix.append(int(mask_lines[i]))
-    
-    for i in range(y_axis):
-        for j in range(x_axis):
-            number = 0
-            index_mask = 0
-            denominator = 0
-            for x in range(-(mask_size//2), (mask_size//2)+1, 1):
-                for y in range(-(mask_size//2), (mask_size//2)+1, 1):
-                    try:
-                        number += (sum(src.get(i+x, j+y))//3 ) * matrix[index_mask]
-                        denominator = denominator + matrix[index_mask]
-                        index_mask += 1
-                    except:
-                        index_mask += 1
-                        continue
-            if average==True:
-                number=int(number//denominator)
-            if number < 0 or number > 255:
-                number=min(max(0,number), 255)
-            newImage.set(i,j,(number,number,number))
-
-    return newImage
+def _expand_into(source, channels: int, target,
+                 keep: tuple = (True,) * 3) -> None:
+    """Writes pixels into a zero-filled RGB buffer, one channel at a time.
+
+    Args:
+    - source: the pixel bytes, row by row.
+    - channels: bytes per pixel in source; 1 for gray values standing for
+      3 equal channels, 3 for RGB.
+    - target: zero-filled buffer receiving the RGB bytes.
+    - keep: for red, green and blue, whether to write it or leave it 0.
+
+    Returns:
+    none
+    """
+    for ch in range(3):
+        if keep[ch]:
+            target[ch::3] = source[min(ch, channels - 1)::channels]
+
+
+def _gray_image(plane, size: (int, int), out: MyImage = None) -> MyImage:
+    """Returns an array-based image whose 3 channels all hold plane.
+
+    Args:
+    - plane: one gray value per pixel, row by row.
+    - size: (width, height) of the image.
+    - out: optional image to write to instead of a new one.
+
+    Returns:
+    the gray image.
+    """
+    img = _result_image(size, out)
+    _expand_into(plane, 1, img.pixels.view())
+    return img
+
+
+def _engine(engine: str = None) -> str:
+    """Returns the apply_mask engine to use, checking the requested one.
+
+    Args:
+    - engine: 'numpy', 'python', 'fft' or None for the default.
+
+    Returns:
+    the engine name; 'numpy' by default if numpy is installed.
+    """
+    if engine is None:
+        engine = 'python' if convolution.np is None else 'numpy'
+    if engine not in ('numpy', 'python', 'fft'):
+        raise ValueError(f'Unknown apply_mask engine: {engine}')
+    if engine != 'python' and convolution.np is None:
+        raise ValueError(f'The {engine} apply_mask engine needs numpy')
+    return engine
+
+
+def apply_mask(src: MyImage, maskfile: str, average: bool = True,
+               engine: str = None, workers: int = 1,
+               out: MyImage = None) -> MyImage:
+    """Returns a grayscale copy of src with the mask in maskfile applied.
+
+    Each output pixel is the weighted sum of the gray values under the
+    mask centred on it. Taps falling outside src are ignored. src is not
+    modified.
+
+    Args:
+    - src: the image to which the mask is applied.
+    - maskfile: path to a file holding the mask size followed by its
+      weights, one number per line.
+    - average: divide each weighted sum by the sum of the weights used.
+    - engine: 'numpy', 'python' or 'fft'. Defaults to 'numpy' if numpy is
+      installed, else 'python'. All produce identical pixels. 'numpy' and
+      'python' apply separable masks as a horizontal then a vertical pass,
+      and masks whose weights are all equal in O(1) per pixel from a
+      summed-area table; 'numpy' applies other masks by FFT from a size
+      measured on first use, see convolution.fft_min_size.
+    - workers: if more than 1, split the image into this many bands of
+      rows and mask them in parallel worker processes. Otherwise an image
+      mapped from a file is masked one band at a time, so that it need not
+      fit in memory; see convolution.convolve_banded.
+    - out: optional array-based image of the size of src to store the
+      result in instead of a new image. It may be src itself, unless src
+      is masked in bands.
+
+    Returns:
+    the masked grayscale image.
+    """
+    mask = convolution.load_mask(maskfile)
+    engine = _engine(engine)
+    x_axis, y_axis = src.size
+    if workers <= 1 and isinstance(src.pixels, MappedList):
+        # bands read rows of src above them, which would be overwritten
+        assert out is None or out.pixels is not src.pixels, 'Cannot mask '\
+            'an image mapped from a file into itself'
+        img = _result_image(src.size, out)
+        source, target = src.pixels.view(), img.pixels.view()
+
+        def read(top, bottom):
+            return convolution.gray_plane(source[3*x_axis*top:3*x_axis*bottom])
+
+        def write(first, last, plane):
+            _expand_into(plane, 1, target[3*x_axis*first:3*x_axis*last])
+
+        convolution.convolve_banded(read, write, x_axis, y_axis, mask, average,
+                                    engine)
+        return img
+    args = (src.gray(), x_axis, y_axis, mask, average, engine)
+    if workers > 1:
+        plane = convolution.convolve_parallel(*args, workers)
+    else:
+        plane = convolution.convolve(*args)
+    return _gray_image(plane, src.size, out)
+
+
+def update_mask(src: MyImage, maskfile: str, out: MyImage,
+                average: bool = True, engine: str = None,
+                rects: list = None) -> MyImage:
+    """Brings out, the result of apply_mask on src, up to date with changes
+    to src, recomputing only the pixels they can affect.
+
+    A written pixel of src changes the output pixels whose masks cover it,
+    so each dirty rectangle of src is grown by the reach of the mask, and
+    the grown rectangle is masked from the pixels of src around it.
+
+    Args:
+    - src: the image to which the mask is applied.
+    - maskfile, average, engine: as for apply_mask.
+    - out: the array-based image of the size of src to update.
+    - rects: the (r0, c0, r1, c1) rectangles of src that changed, see
+      MyImage.take_dirty; by default src.take_dirty(). On its first call
+      that is the whole image, so the first update is a full apply_mask.
+
+    Returns:
+    out
+    """
+    mask = convolution.load_mask(maskfile)
+    engine = _engine(engine)
+    assert out.size == src.size and not out.pointer, f'Cannot update '\
+        f'{"pointer-based " if out.pointer else ""}image of size {out.size} '\
+        f'from image of size {src.size}'
+    width, height = src.size
+    # output pixel i reads source pixels i-before .. i+after
+    before = mask.size // 2
+    after = mask.size - 1 - before
+    for r0, c0, r1, c1 in src.take_dirty() if rects is None else rects:
+        # the output pixels reading the rectangle, and the pixels they read
+        top, bottom = max(0, r0 - after), min(height, r1 + before)
+        left, right = max(0, c0 - after), min(width, c1 + before)
+        if top >= bottom or left >= right:
+            continue
+        wtop, wbottom = max(0, top - before), min(height, bottom + after)
+        wleft, wright = max(0, left - before), min(width, right + after)
+        gray = convolution.gray_plane(
+            _window_bytes(src, wtop, wleft, wbottom, wright))
+        plane = convolution.convolve(gray, wright - wleft, wbottom - wtop,
+                                     mask, average, engine)
+
+        out._own(top, left, bottom, right)
+        view = out.pixels.view()
+        span = wright - wleft
+        for r in range(top, bottom):
+            first = (r - wtop) * span + left - wleft
+            _expand_into(plane[first:first + right - left], 1,
+                         view[3*(r*width + left):3*(r*width + right)])
+    return out
+
+
+def _window_bytes(src: MyImage, r0: int, c0: int, r1: int, c1: int) -> bytes:
+    """Returns the RGB bytes of a rectangle of src, row by row.
+
+    Args:
+    - src: the image.
+    - r0, c0: the top left corner of the rectangle.
+    - r1, c1: one past its bottom right corner.
+
+    Returns:
+    the bytes of rows r0..r1-1, columns c0..c1-1.
+    """
+    width = src.size[0]
+    if src.pointer:
+        # consecutive indices, so each step of the walk is from the finger
+        return bytes(channel for r in range(r0, r1) for c in range(c0, c1)
+                     for channel in src.pixels[r*width + c])
+    view = src.pixels.view()
+    return b''.join(view[3*(r*width + c0):3*(r*width + c1)]
+                    for r in range(r0, r1))
+
+
+def apply_masks(src: MyImage, maskfiles: list, averages: list = None,
+                engine: str = None) -> list:
+    """Returns grayscale copies of src with each of the masks applied.
+
+    The result is the same as calling apply_mask once per mask, but masks
+    of the same size are applied in a single sweep over src, reading the
+    neighbourhood of each pixel once for all of them. src is not modified.
+
+    Args:
+    - src: the image to which the masks are applied.
+    - maskfiles: paths to the mask files, see apply_mask.
+    - averages: for each mask, whether to divide each weighted sum by the
+      sum of the weights used; all True by default.
+    - engine: as for apply_mask.
+
+    Returns:
+    the masked grayscale images, in the order of maskfiles.
+    """
+    if averages is None:
+        averages = [True] * len(maskfiles)
+    assert len(averages) == len(maskfiles), f'{len(averages)} averages '\
+        f'given for {len(maskfiles)} masks'
+    masks = [convolution.load_mask(maskfile) for maskfile in maskfiles]
+    x_axis, y_axis = src.size
+    planes = convolution.convolve_many(src.gray(), x_axis, y_axis, masks,
+                                       averages, _engine(engine))
+    return [_gray_image(plane, src.size) for plane in planes]
+
+
+def lazy(src: MyImage) -> 'LazyImage':
+    """Returns a LazyImage on which operations on src can be chained.
+
+    Args:
+    - src: the image the operations start from.
+
+    Returns:
+    a LazyImage recording no operations yet.
+    """
+    return LazyImage(src)
+
+
+class LazyImage:
+    """ Records remove_channel, apply_mask and rotations calls on an image and
+    runs them together on compute().
+
+    Channel suppression is folded into the grayscale conversion of a later
+    apply_mask, or into the copy writing the result, and a final rotations
+    writes straight into the result. The result is the only image allocated:
+        lazy(img).remove_channel(green=True).apply_mask('mask.txt')\
+            .rotations().compute()
+    gives the same pixels as calling the 3 operations one after the other.
+    """
+    def __init__(self, src: MyImage, ops: tuple = ()) -> None:
+        """Initializes the graph of operations ops on src.
+        Args:
+        - src: the image the operations start from. It is not modified.
+        - ops: (name, keyword arguments) of the operations, in order.
+        Returns:
+        none
+        """
+        self.src = src
+        self.ops = ops
+
+    def _then(self, name: str, **kwargs) -> 'LazyImage':
+        """Returns a LazyImage with operation name appended to this one's.
+        Args:
+        - name: the operation.
+        - kwargs: its arguments.
+        Returns:
+        the new LazyImage; this one is unchanged.
+        """
+        return LazyImage(self.src, self.ops + ((name, kwargs),))
+
+    def remove_channel(self, red: bool = False, green: bool = False,
+                       blue: bool = False) -> 'LazyImage':
+        """Records remove_channel, see image_operations.remove_channel.
+        Args:
+        - red, green, blue: the channels to suppress; red if none is given.
+        Returns:
+        a LazyImage with the operation recorded.
+        """
+        if not (red or green or blue):
+            red = True
+        return self._then('remove_channel', red=red, green=green, blue=blue)
+
+    def apply_mask(self, maskfile: str, average: bool = True,
+                   engine: str = None, workers: int = 1) -> 'LazyImage':
+        """Records apply_mask, see image_operations.apply_mask.
+        Args:
+        - maskfile, average, engine, workers: as for apply_mask.
+        Returns:
+        a LazyImage with the operation recorded.
+        """
+        return self._then('apply_mask', maskfile=maskfile, average=average,
+                          engine=engine, workers=workers)
+
+    def rotations(self) -> 'LazyImage':
+        """Records rotations, see image_operations.rotations.
+        Args:
+        Returns:
+        a LazyImage with the operation recorded.
+        """
+        return self._then('rotations')
+
+    def compute(self) -> MyImage:
+        """Runs the recorded operations and returns the resulting image.
+        The result is pointer-based if src is and no mask is applied, like
+        the result of calling the operations one by one.
+        Args:
+        Returns:
+        a new image; src is not modified.
+        """
+        # the pixels so far: channels bytes per pixel (1 for gray values
+        # standing for 3 equal channels), with the channels not in keep
+        # still to be zeroed
+        data = source = _pixel_bytes(self.src)
+        channels = 3
+        keep = (True,) * 3
+        size = self.src.size
+        pointer = self.src.pointer
+
+        for step, (name, kwargs) in enumerate(self.ops):
+            if name == 'remove_channel':
+                suppress = (kwargs['red'], kwargs['green'], kwargs['blue'])
+                keep = tuple(k and not s for k, s in zip(keep, suppress))
+            elif name == 'apply_mask':
+                mask = convolution.load_mask(kwargs['maskfile'])
+                engine = _engine(kwargs['engine'])
+                if data is source and keep == (True,) * 3:
+                    gray = self.src.gray()
+                else:
+                    gray = convolution.gray_plane(data, channels, keep)
+                args = (gray, size[0], size[1], mask, kwargs['average'],
+                        engine)
+                if kwargs['workers'] > 1:
+                    data = convolution.convolve_parallel(*args,
+                                                         kwargs['workers'])
+                else:
+                    data = convolution.convolve(*args)
+                channels = 1
+                keep = (True,) * 3
+                pointer = False
+            else:
+                n = size[0]
+                assert n == size[1], f'Cannot rotate non-square image of '\
+                    f'size: {size}'
+                size = (2 * n, 2 * n)
+                if step == len(self.ops) - 1:
+                    # last operation: rotate straight into the result
+                    result, target = _new_result(size, pointer)
+                    _rotate_into(data, channels, n, target, 3, keep)
+                    return _finish_result(result, size, target)
+                rotated = bytearray(channels * size[0] * size[1])
+                _rotate_into(data, channels, n, rotated, channels)
+                data = rotated
+
+        result, target = _new_result(size, pointer)
+        _expand_into(data, channels, target, keep)
+        return _finish_result(result, size, target)
+
+
+def _new_result(size: (int, int), pointer: bool):
+    """Returns a black image of the given size and a buffer to write it.
+
+    Args:
+    - size: (width, height) of the image.
+    - pointer: if True then the image will be pointer-based.
+
+    Returns:
+    (image, buffer): an array-based image and a view of its pixels, or None
+    and a bytearray to be turned into a pointer-based image by _finish_result.
+    """
+    if pointer:
+        return None, bytearray(3 * size[0] * size[1])
+    result = MyImage(size)
+    return result, result.pixels.view()
+
+
+def _finish_result(result: MyImage, size: (int, int), target) -> MyImage:
+    """Returns the image written through a buffer from _new_result.
+
+    Args:
+    - result, target: as returned by _new_result.
+    - size: (width, height) of the image.
+
+    Returns:
+    the image.
+    """
+    if result is None:
+        return _image_from_bytes(size, True, target)
+    return result
 
 # def apply_mask(src: MyImage, maskfile: str, average: bool = True) -> MyImage:
     
@@ -0,0 +1,311 @@
+"""Batch processing of image files through a chain of image operations.
+
+A Pipeline records operations from image_operations and then runs them over
+many files:
+
+    stats = Pipeline().remove_channel(red=True)\
+                      .apply_mask('mask-blur.txt')\
+                      .run('photos/*.jpg', 'out', workers=8)
+    print(stats.report())
+
+Each file is decoded, processed and encoded by one task in a pool of worker
+processes, so the three stages of different files overlap. At most
+max_in_flight tasks are submitted at a time, which bounds the number of
+decoded images held in memory.
+"""
+from concurrent.futures import (ALL_COMPLETED, FIRST_COMPLETED,
+                                ProcessPoolExecutor, wait)
+from glob import iglob
+from time import perf_counter
+import os
+
+from image_operations import (MyImage, apply_mask, lazy, remove_channel,
+                              rotations)
+
+STAGES = ('decode', 'process', 'encode')
+
+
+class PipelineStats:
+    """Counts images and pixels, and times each stage of a pipeline run.
+    """
+
+    def __init__(self) -> None:
+        """Initializes empty statistics.
+        Args:
+        Returns:
+        none
+        """
+        self.images = 0
+        self.pixels = 0
+        # seconds spent in each stage, summed over all worker processes
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.wall = 0.0
+        # (path, error) for each file that could not be processed
+        self.failed = []
+
+    def add(self, pixels: int, seconds: dict) -> None:
+        """Records one processed image.
+        Args:
+        - pixels: the number of pixels in the decoded image.
+        - seconds: the time spent on the image in each stage.
+        Returns:
+        none
+        """
+        self.images += 1
+        self.pixels += pixels
+        for stage in STAGES:
+            self.seconds[stage] += seconds[stage]
+
+    def report(self) -> str:
+        """Returns a human readable summary of the throughput of each stage.
+        Stage throughput is per worker: images over the time the workers
+        spent in that stage. The total line is over wall-clock time.
+        Args:
+        Returns:
+        one line per stage and a total line.
+        """
+        lines = []
+        for stage in STAGES + ('total',):
+            seconds = self.wall if stage == 'total' else self.seconds[stage]
+            rate = self.images / seconds if seconds else 0.0
+            megapixels = self.pixels / seconds / 1e6 if seconds else 0.0
+            lines.append(f'{stage:>8}: {self.images} images in '
+                         f'{seconds:.2f}s, {rate:.2f} images/s, '
+                         f'{megapixels:.2f} MP/s')
+        if self.failed:
+            lines.append(f'{len(self.failed)} failed: '
+                         + ', '.join(path for path, error in self.failed))
+        return '\n'.join(lines)
+
+
+class Pipeline:
+    """A chain of image operations to run over many image files.
+    """
+
+    def __init__(self, pointer: bool = False) -> None:
+        """Initializes an empty pipeline.
+        Args:
+        - pointer: if True then images are decoded into pointer-based lists.
+        Returns:
+        none
+        """
+        self.pointer = pointer
+        # (operation, keyword arguments) in the order they are applied
+        self.steps = []
+
+    def remove_channel(self, red: bool = False, green: bool = False,
+                       blue: bool = False) -> 'Pipeline':
+        """Appends image_operations.remove_channel to the pipeline.
+        Args:
+        - red, green, blue: the channels to suppress, as for remove_channel.
+        Returns:
+        this pipeline, so that calls can be chained.
+        """
+        self.steps.append((remove_channel,
+                           dict(red=red, green=green, blue=blue)))
+        return self
+
+    def rotations(self) -> 'Pipeline':
+        """Appends image_operations.rotations to the pipeline.
+        Args:
+        Returns:
+        this pipeline, so that calls can be chained.
+        """
+        self.steps.append((rotations, {}))
+        return self
+
+    def apply_mask(self, maskfile: str, average: bool = True,
+                   engine: str = None) -> 'Pipeline':
+        """Appends image_operations.apply_mask to the pipeline.
+        Args:
+        - maskfile, average, engine: as for apply_mask.
+        Returns:
+        this pipeline, so that calls can be chained.
+        """
+        self.steps.append((apply_mask, dict(maskfile=maskfile,
+                                            average=average, engine=engine)))
+        return self
+
+    def process(self, img: MyImage) -> MyImage:
+        """Returns the result of applying the pipeline's operations to img.
+        The operations run fused, through image_operations.lazy, so that
+        only the result image is allocated.
+        Args:
+        - img: the image to process.
+        Returns:
+        the processed image.
+        """
+        graph = lazy(img)
+        for operation, kwargs in self.steps:
+            graph = getattr(graph, operation.__name__)(**kwargs)
+        return graph.compute()
+
+    def run(self, inputs, output_dir: str, workers: int = None,
+            max_in_flight: int = None, extension: str = None
+            ) -> PipelineStats:
+        """Runs the pipeline over image files, writing results to output_dir.
+        Args:
+        - inputs: a directory, a glob pattern, or an iterable of file paths.
+        - output_dir: results are written here under the input file names;
+          a ValueError is raised if two inputs share a name.
+        - workers: the number of worker processes; defaults to the number of
+          CPUs. With 1 worker, files are processed in this process.
+        - max_in_flight: the most files being processed at once, and so the
+          most decoded images in memory; defaults to twice workers.
+        - extension: optional extension, e.g. '.png', replacing that of each
+          input file name to pick the output format. '.raw' writes
+          uncompressed files that are fastest to write and read back.
+        Returns:
+        the statistics of the run.
+        """
+        workers = workers or os.cpu_count() or 1
+        max_in_flight = max(max_in_flight or 2 * workers, 1)
+        os.makedirs(output_dir, exist_ok=True)
+        stats = PipelineStats()
+        start = perf_counter()
+        tasks = _tasks(inputs, output_dir, extension)
+        if workers == 1:
+            for path, output in tasks:
+                _collect(stats, path, _run_file, self, path, output)
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                pending = {}
+                for path, output in tasks:
+                    if len(pending) >= max_in_flight:
+                        _drain(stats, pending, FIRST_COMPLETED)
+                    future = pool.submit(_run_file, self, path, output)
+                    pending[future] = path
+                _drain(stats, pending)
+        stats.wall = perf_counter() - start
+        return stats
+
+
+def _input_paths(inputs):
+    """Yields the image files named by inputs, see Pipeline.run.
+
+    Args:
+    - inputs: a directory, a glob pattern, or an iterable of file paths.
+
+    Returns:
+    a generator of file paths; directories are listed in sorted order.
+    """
+    if isinstance(inputs, str):
+        if os.path.isdir(inputs):
+            for name in sorted(os.listdir(inputs)):
+                path = os.path.join(inputs, name)
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield from sorted(iglob(inputs))
+    else:
+        yield from inputs
+
+
+def _output_path(path: str, output_dir: str, extension: str = None) -> str:
+    """Returns where the result for input file path is written.
+
+    Args:
+    - path: the input file.
+    - output_dir: the output directory.
+    - extension: optional replacement for the extension of path.
+
+    Returns:
+    the output file path.
+    """
+    name = os.path.basename(path)
+    if extension:
+        name = os.path.splitext(name)[0] + extension
+    return os.path.join(output_dir, name)
+
+
+def _tasks(inputs, output_dir: str, extension: str = None) -> list:
+    """Returns the input file and output file of each task of a run.
+
+    Outputs are named by the base names of the inputs, so inputs from
+    different directories may clash; a ValueError is raised before any file
+    is processed if two inputs would be written to the same output file.
+
+    Args:
+    - inputs: a directory, a glob pattern, or an iterable of file paths.
+    - output_dir: the output directory.
+    - extension: optional replacement for the extension of input files.
+
+    Returns:
+    a list of (input path, output path) pairs.
+    """
+    tasks = [(path, _output_path(path, output_dir, extension))
+             for path in _input_paths(inputs)]
+    inputs = {}
+    for path, output in tasks:
+        if output in inputs:
+            raise ValueError(f'{inputs[output]} and {path} would both be '
+                             f'written to {output}')
+        inputs[output] = path
+    return tasks
+
+
+def _run_file(pipeline: Pipeline, path: str, output: str) -> (int, dict):
+    """Decodes, processes and encodes one file, timing each stage.
+
+    This is the task run by worker processes.
+
+    Args:
+    - pipeline: the pipeline to apply.
+    - path: the input file.
+    - output: the output file.
+
+    Returns:
+    the number of pixels in the input and the seconds spent in each stage.
+    """
+    seconds = {}
+    start = perf_counter()
+    img = MyImage.open(path, pointer=pipeline.pointer)
+    width, height = img.size
+    seconds['decode'] = perf_counter() - start
+
+    start = perf_counter()
+    img = pipeline.process(img)
+    seconds['process'] = perf_counter() - start
+
+    start = perf_counter()
+    img.save(output)
+    seconds['encode'] = perf_counter() - start
+    return width * height, seconds
+
+
+def _collect(stats: PipelineStats, path: str, function, *args) -> None:
+    """Records the outcome of function(*args), a run over file path.
+
+    Args:
+    - stats: the statistics to update.
+    - path: the input file.
+    - function: a callable returning what _run_file returns; for pool tasks
+      this is the result method of the task's future.
+    - args: the arguments to function.
+
+    Returns:
+    none
+    """
+    try:
+        stats.add(*function(*args))
+    except Exception as error:
+        stats.failed.append((path, repr(error)))
+
+
+def _drain(stats: PipelineStats, pending: dict,
+           return_when: str = ALL_COMPLETED) -> None:
+    """Waits for pending tasks and records their outcomes.
+
+    Args:
+    - stats: the statistics to update.
+    - pending: maps futures of running tasks to their input files; finished
+      tasks are removed from it.
+    - return_when: ALL_COMPLETED, or FIRST_COMPLETED to wait for at least
+      one task only.
+
+    Returns:
+    none
+    """
+    done, running = wait(pending, return_when=return_when)
+    for future in done:
+        _collect(stats, pending.pop(future), future.result)
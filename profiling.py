@@ -0,0 +1,237 @@
+"""Opt-in counters and phase timers for the image operations.
+
+Nothing is instrumented until profile() is entered:
+
+    with profile() as stats:
+        img = MyImage.open('campus.jpeg', pointer=True)
+        apply_mask(img, 'mask-blur.txt').save('out.png')
+    print(stats.report())
+
+Inside the block the functions below are replaced by wrappers that count
+and time their calls; on leaving it the originals are put back, so code run
+outside a profile() block pays nothing. Wrappers are installed on the
+classes and modules that define the functions, so calls made through those
+(all calls made by the operations themselves) are seen, while references
+taken with `from module import name` before profiling are not.
+
+Counters:
+- get, set: calls to MyImage.get and MyImage.set.
+- bytes: bytes moved by the bulk copies between lists and buffers.
+- nodes: PointerList nodes visited, by walks to an index, iteration, the
+  bulk copies to and from bytes and rebuilds of the skip index.
+
+Phases (open and save include their decode/unpack and pack phases):
+- open, decode, unpack: MyImage.open, PIL decoding, filling the list.
+- save, pack: MyImage.save, and building the PIL image; the rest of save
+  is PIL encoding.
+- rotate, expand: copying rotations, and gray or RGB pixels, into images.
+- load_mask, gray, convolve: the phases of apply_mask.
+"""
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+from APL import ArrayList, MappedList, PointerList
+import convolution
+import image_operations
+from image_operations import MyImage
+
+COUNTERS = ('get', 'set', 'bytes', 'nodes')
+PHASES = ('open', 'decode', 'unpack', 'save', 'pack', 'rotate', 'expand',
+          'load_mask', 'gray', 'convolve')
+
+# the statistics being collected, if a profile() block is active
+_active = None
+
+
+class Stats:
+    """Counts and phase times collected by a profile() block.
+    """
+
+    def __init__(self) -> None:
+        """Initializes empty statistics.
+        Args:
+        Returns:
+        none
+        """
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        # seconds spent in, and calls to, each phase
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.calls = dict.fromkeys(PHASES, 0)
+
+    def report(self) -> str:
+        """Returns a human readable summary of the statistics.
+        Args:
+        Returns:
+        a line of counters, then one line per phase that was entered.
+        """
+        lines = [', '.join(f'{name}: {count}'
+                           for name, count in self.counts.items())]
+        for phase in PHASES:
+            if self.calls[phase]:
+                lines.append(f'{phase:>9}: {self.seconds[phase]:.4f}s in '
+                             f'{self.calls[phase]} calls')
+        return '\n'.join(lines)
+
+
+def _timed(stats: Stats, phase: str, function):
+    """Returns a wrapper of function adding its calls to a phase of stats.
+
+    Args:
+    - stats: the statistics to update.
+    - phase: the phase the calls belong to.
+    - function: the function to wrap.
+
+    Returns:
+    the wrapper.
+    """
+    @wraps(function)
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.seconds[phase] += perf_counter() - start
+            stats.calls[phase] += 1
+    return timed
+
+
+def _counted(stats: Stats, counter: str, function, amount=None):
+    """Returns a wrapper of function adding to a counter of stats per call.
+
+    Args:
+    - stats: the statistics to update.
+    - counter: the counter to add to.
+    - function: the function to wrap.
+    - amount: optional function of the call's arguments and result giving
+      how much to add; 1 is added per call by default.
+
+    Returns:
+    the wrapper.
+    """
+    @wraps(function)
+    def counted(*args, **kwargs):
+        result = function(*args, **kwargs)
+        stats.counts[counter] += 1 if amount is None else amount(args, result)
+        return result
+    return counted
+
+
+def _iterated(stats: Stats, counter: str, function):
+    """Returns a wrapper of a generator function adding 1 to a counter of
+    stats per value it yields.
+
+    Args:
+    - stats: the statistics to update.
+    - counter: the counter to add to.
+    - function: the generator function to wrap.
+
+    Returns:
+    the wrapper.
+    """
+    @wraps(function)
+    def iterated(*args, **kwargs):
+        for value in function(*args, **kwargs):
+            stats.counts[counter] += 1
+            yield value
+    return iterated
+
+
+def _instruments(stats: Stats) -> list:
+    """Returns the wrappers to install for stats.
+
+    Args:
+    - stats: the statistics the wrappers update.
+
+    Returns:
+    (owner, name, wrapper) for each function to replace: owner is the class
+    or module defining the function and name its attribute there.
+    """
+    def result_length(args, result):
+        return len(result)
+
+    def argument_length(index):
+        return lambda args, result: len(args[index])
+
+    def steps(args, result):
+        return abs(args[2])
+
+    def size(args, result):
+        return args[0].size
+
+    instruments = [
+        (MyImage, 'get', _counted(stats, 'get', MyImage.get)),
+        (MyImage, 'set', _counted(stats, 'set', MyImage.set)),
+        (PointerList, '_walk',
+         _counted(stats, 'nodes', PointerList._walk, steps)),
+        (PointerList, '_build_skip',
+         _counted(stats, 'nodes', PointerList._build_skip, size)),
+        (PointerList, '__iter__',
+         _iterated(stats, 'nodes', PointerList.__iter__)),
+        (MyImage, 'open', _timed(stats, 'open', MyImage.open)),
+        (MyImage, 'save', _timed(stats, 'save', MyImage.save)),
+        (MyImage, '_to_pil', _timed(stats, 'pack', MyImage._to_pil)),
+        (image_operations, '_decode',
+         _timed(stats, 'decode', image_operations._decode)),
+        (image_operations, '_image_from_bytes',
+         _timed(stats, 'unpack', image_operations._image_from_bytes)),
+        (image_operations, '_rotate_into', _counted(
+            stats, 'bytes', _timed(stats, 'rotate',
+                                   image_operations._rotate_into),
+            argument_length(3))),
+        (image_operations, '_expand_into', _counted(
+            stats, 'bytes', _timed(stats, 'expand',
+                                   image_operations._expand_into),
+            argument_length(2))),
+        (convolution, 'load_mask',
+         _timed(stats, 'load_mask', convolution.load_mask)),
+        (convolution, 'gray_plane', _timed(stats, 'gray',
+                                           convolution.gray_plane)),
+        (convolution, 'convolve', _timed(stats, 'convolve',
+                                         convolution.convolve)),
+        (convolution, 'convolve_parallel',
+         _timed(stats, 'convolve', convolution.convolve_parallel)),
+    ]
+    for lst in (ArrayList, PointerList, MappedList):
+        tobytes, frombytes = lst.tobytes, lst.frombytes
+        if lst is PointerList:
+            # both visit every node once
+            tobytes = _counted(stats, 'nodes', tobytes, size)
+            frombytes = _counted(stats, 'nodes', frombytes, size)
+        instruments += [
+            (lst, 'tobytes',
+             _counted(stats, 'bytes', tobytes, result_length)),
+            (lst, 'frombytes',
+             _counted(stats, 'bytes', frombytes, argument_length(1))),
+            (lst, 'copy', _counted(stats, 'bytes', lst.copy,
+                                   lambda args, result: 3 * len(result))),
+        ]
+    return instruments
+
+
+@contextmanager
+def profile():
+    """Collects statistics on the image operations run inside the block.
+
+    Profiling blocks cannot be nested.
+
+    Args:
+
+    Returns:
+    a context manager whose value is the Stats being collected; they can be
+    read during and after the block.
+    """
+    global _active
+    assert _active is None, 'A profile() block is already active'
+    _active = stats = Stats()
+    instruments = _instruments(stats)
+    originals = [(owner, name, owner.__dict__[name])
+                 for owner, name, wrapper in instruments]
+    try:
+        for owner, name, wrapper in instruments:
+            setattr(owner, name, wrapper)
+        yield stats
+    finally:
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+        _active = None
@@ -0,0 +1,570 @@
+from image_operations import *
+from PIL import Image
+import benchmark
+import convolution
+import gc
+import json
+import os
+import pipeline
+import profiling
+import pytest
+import tracemalloc
+
+SOURCE_IMAGE = 'hu-logo.png'
+MASKS = ['mask-blur.txt', 'mask-blur-more.txt', 'mask-blur-slightly.txt',
+         'mask-sobel-x.txt', 'mask-sobel-y.txt']
+
+
+def small_image(size=(23, 17), pointer=False, tmp_path=None) -> MyImage:
+    img = MyImage.open(SOURCE_IMAGE)
+    small = MyImage(size)
+    width, height = size
+    for r in range(height):
+        for c in range(width):
+            small.set(r, c, img.get(r + 40, c + 40))
+    if pointer:
+        path = str(tmp_path / 'small.png')
+        small.save(path)
+        return MyImage.open(path, pointer=True)
+    return small
+
+
+def write_mask(tmp_path, weights: list) -> str:
+    size = int(len(weights) ** 0.5)
+    path = str(tmp_path / 'mask.txt')
+    with open(path, 'w') as f:
+        f.write('\n'.join(map(str, [size] + weights)))
+    return path
+
+
+def reference_mask(img: MyImage, weights: list, average: bool) -> list:
+    """The original per-pixel definition of apply_mask."""
+    width, height = img.size
+    size = int(len(weights) ** 0.5)
+    result = []
+    for i in range(height):
+        for j in range(width):
+            number = denominator = 0
+            for x in range(size):
+                for y in range(size):
+                    r, c = i + x - size//2, j + y - size//2
+                    if 0 <= r < height and 0 <= c < width:
+                        number += sum(img.get(r, c))//3 * weights[x*size + y]
+                        denominator += weights[x*size + y]
+            if average:
+                number //= denominator
+            number = min(max(0, number), 255)
+            result.append((number, number, number))
+    return result
+
+
+def masked(img: MyImage, maskfile: str, average: bool, **kwargs):
+    try:
+        return list(apply_mask(img, maskfile, average, **kwargs).pixels)
+    except ZeroDivisionError:
+        return ZeroDivisionError
+
+
+def test_open_save_roundtrip(tmp_path):
+    output = str(tmp_path / 'output.png')
+    for pointer in (False, True):
+        MyImage.open(SOURCE_IMAGE, pointer=pointer).save(output)
+        assert Image.open(output).tobytes() == \
+            Image.open(SOURCE_IMAGE).convert('RGB').tobytes(),\
+            f'open/save of {SOURCE_IMAGE} (pointer={pointer}) is lossy'
+
+
+def test_array_list_byte_storage():
+    lst = ArrayList(4, value=(1, 2, 3))
+    lst[2] = (255, 0, 128)
+    assert [rgb for rgb in lst] == [(1, 2, 3), (1, 2, 3), (255, 0, 128), (1, 2, 3)]
+    assert lst.view().nbytes == 12
+    assert lst.tobytes()[6:9] == bytes((255, 0, 128))
+    view = lst.view()
+    lst.frombytes(bytes(range(12)))
+    view[0:3] = b'\x07\x07\x07'
+    assert list(lst) == [(7, 7, 7), (3, 4, 5), (6, 7, 8), (9, 10, 11)]
+
+
+@pytest.mark.skipif(convolution.np is None, reason='numpy is not installed')
+def test_numpy_mask_matches_python():
+    img = small_image()
+    for maskfile in MASKS:
+        for average in (True, False):
+            assert masked(img, maskfile, average, engine='numpy') == \
+                masked(img, maskfile, average, engine='python'),\
+                f'numpy engine differs under {maskfile}, average={average}'
+
+
+def test_separable_mask(tmp_path):
+    assert convolution.separate([-1, 0, 1, -2, 0, 2, -1, 0, 1], 3) == \
+        ([1, 2, 1], [-1, 0, 1])
+    assert convolution.separate([1, 3, 1, 3, 5, 3, 1, 3, 1], 3) is None
+    img = small_image()
+    weights = [2, 4, 2, 4, 8, 4, 2, 4, 2]
+    maskfile = write_mask(tmp_path, weights)
+    for average in (True, False):
+        for engine in ('python', 'numpy'):
+            if engine == 'numpy' and convolution.np is None:
+                continue
+            assert masked(img, maskfile, average, engine=engine) \
+                == reference_mask(img, weights, average),\
+                f'separable {engine} engine differs, average={average}'
+
+
+def test_rotations_quadrants(tmp_path):
+    for pointer in (False, True):
+        src = small_image((9, 9), pointer, tmp_path)
+        dst = rotations(src)
+        assert dst.size == (18, 18)
+        for r in range(9):
+            for c in range(9):
+                assert dst.get(r, c) == src.get(c, 8 - r)
+                assert dst.get(r + 9, c) == src.get(8 - r, 8 - c)
+                assert dst.get(r + 9, c + 9) == src.get(8 - c, r)
+                assert dst.get(r, c + 9) == src.get(r, c)
+
+
+def test_pointer_list_random_access():
+    lst = PointerList(50, value=(0, 0, 0))
+    model = [(0, 0, 0)] * 50
+    for i in (0, 7, 49, 23, 8, 48):
+        lst[i] = model[i] = (i, i, i)
+    lst.insert(10, (1, 2, 3))
+    model.insert(10, (1, 2, 3))
+    assert len(lst) == 51
+    assert [lst[i] for i in range(51)] == model
+    assert [lst[i] for i in reversed(range(51))] == model[::-1]
+
+
+def test_pointer_list_construction():
+    lst = PointerList.from_iterable([(1, 1, 1), (2, 2, 2)])
+    lst.extend([(3, 3, 3)])
+    lst.append((4, 4, 4))
+    lst.insert(4, (5, 5, 5))
+    assert len(lst) == 5 and lst.tail.value == (5, 5, 5)
+    assert [lst[i] for i in range(5)] == [(i, i, i) for i in range(1, 6)]
+    assert len(PointerList(1000, value=(0, 0, 0))) == 1000
+
+
+def test_list_iterators():
+    values = [(i, 2 * i, 255 - i) for i in range(10)]
+    pointer = PointerList.from_iterable(values)
+    array = ArrayList(10)
+    for i, rgb in enumerate(values):
+        array[i] = rgb
+    for lst, iterator in ((pointer, PointerListIterator),
+                          (array, ArrayListIterator)):
+        assert list(lst) == values
+        assert list(iterator(lst)) == values
+
+
+def test_pointer_list_bidirectional():
+    lst = PointerList.from_iterable(range(100))
+    lst.insert(0, -1)
+    lst.insert(50, 'x')
+    model = [-1] + list(range(49)) + ['x'] + list(range(49, 100))
+    # nearby accesses in both directions, served from the finger
+    assert [lst[i] for i in (60, 61, 59, 40, 41, 101, 0, 50)] == \
+        [model[i] for i in (60, 61, 59, 40, 41, 101, 0, 50)]
+    backwards, node = [], lst.tail
+    while node is not None:
+        backwards.append(node.value)
+        node = node.prev
+    assert backwards == model[::-1]
+
+
+def test_row_and_region_views():
+    img = small_image((8, 6))
+    assert img.row(2).tobytes() == \
+        bytes(ch for c in range(8) for ch in img.get(2, c))
+    region = img.region(1, 3, 4, 2)
+    assert len(region) == 4 and all(len(view) == 6 for view in region)
+    region[2][0:3] = bytes((1, 2, 3))
+    assert img.get(3, 3) == (1, 2, 3)
+    with pytest.raises(TypeError):
+        img.row(0, readonly=True)[0] = 0
+
+
+def test_parallel_mask_matches_serial():
+    img = small_image()
+    for maskfile in ('mask-blur-more.txt', 'mask-sobel-y.txt'):
+        for average in (True, False):
+            assert masked(img, maskfile, average, engine='python',
+                          workers=3) == \
+                masked(img, maskfile, average, engine='python'),\
+                f'parallel masking differs under {maskfile}, average={average}'
+
+
+def test_mask_cache(tmp_path):
+    maskfile = write_mask(tmp_path, [1, 2, 1, 2, 4, 2, 1, 2, 1])
+    first = convolution.load_mask(maskfile)
+    assert convolution.load_mask(maskfile) is first
+    assert first.total == 16 and first.weight_sum(1, 3, 0, 2) == 9
+    write_mask(tmp_path, [0, 1, 0, 1, 1, 1, 0, 1, 0])
+    os.utime(maskfile, ns=(0, os.stat(maskfile).st_mtime_ns + 10**9))
+    second = convolution.load_mask(maskfile)
+    assert second is not first and second.total == 5
+    # a file renamed over the mask is seen even with the same size and times
+    replacement = maskfile + '.new'
+    with open(replacement, 'w') as f:
+        f.write('3\n1\n0\n1\n0\n1\n0\n1\n0\n1')
+    info = os.stat(maskfile)
+    assert os.stat(replacement).st_size == info.st_size
+    os.utime(replacement, ns=(info.st_atime_ns, info.st_mtime_ns))
+    os.replace(replacement, maskfile)
+    assert convolution.load_mask(maskfile).weights == [1, 0] * 4 + [1]
+
+
+def test_pipeline_matches_operations(tmp_path):
+    small_image((12, 12)).save(str(tmp_path / 'a.png'))
+    small_image((9, 9)).save(str(tmp_path / 'b.png'))
+    steps = pipeline.Pipeline().remove_channel(blue=True)\
+        .apply_mask('mask-blur-slightly.txt').rotations()
+    for workers in (1, 2):
+        stats = steps.run(str(tmp_path / '*.png'), str(tmp_path / 'out'),
+                          workers=workers, max_in_flight=1)
+        assert stats.images == 2 and not stats.failed
+        for name in ('a.png', 'b.png'):
+            img = MyImage.open(str(tmp_path / name))
+            expected = rotations(apply_mask(remove_channel(img, blue=True),
+                                            'mask-blur-slightly.txt'))
+            result = MyImage.open(str(tmp_path / 'out' / name))
+            assert list(result.pixels) == list(expected.pixels)
+
+
+def test_lazy_matches_operations(tmp_path):
+    chains = [[], [('rotations', {})], [('remove_channel', {})],
+              [('remove_channel', dict(green=True)), ('rotations', {})],
+              [('rotations', {}), ('remove_channel', dict(blue=True)),
+               ('rotations', {})],
+              [('remove_channel', dict(red=True, blue=True)),
+               ('apply_mask', dict(maskfile='mask-blur.txt')),
+               ('remove_channel', dict(green=True)), ('rotations', {})],
+              [('rotations', {}),
+               ('apply_mask', dict(maskfile='mask-blur-more.txt',
+                                   engine='python')),
+               ('rotations', {}), ('remove_channel', {})]]
+    operations = dict(remove_channel=remove_channel, rotations=rotations,
+                      apply_mask=apply_mask)
+    for pointer in (False, True):
+        for chain in chains:
+            graph = lazy(small_image((8, 8), pointer, tmp_path))
+            for name, kwargs in chain:
+                graph = getattr(graph, name)(**kwargs)
+            result = graph.compute()
+            expected = small_image((8, 8), pointer, tmp_path)
+            for name, kwargs in chain:
+                expected = operations[name](expected, **kwargs)
+            assert result.size == expected.size
+            assert result.pointer == expected.pointer, chain
+            assert list(result.pixels) == list(expected.pixels), chain
+    with pytest.raises(AssertionError):
+        lazy(small_image((8, 5))).rotations().compute()
+
+
+def test_remove_channel_copy_on_write(tmp_path):
+    for pointer in (False, True):
+        img = small_image((6, 4), pointer, tmp_path)
+        before = list(img.pixels)
+        copy = img.copy()
+        assert copy.pixels is img.pixels
+        copy.set(0, 0, (1, 2, 3))
+        assert copy.pixels is not img.pixels
+        assert list(img.pixels) == before and copy.get(0, 0) == (1, 2, 3)
+
+        result = remove_channel(img, green=True, blue=True)
+        assert list(img.pixels) == before
+        assert list(result.pixels) == [(r, 0, 0) for r, g, b in before]
+        assert remove_channel(img, inplace=True) is img
+        assert list(img.pixels) == [(0, g, b) for r, g, b in before]
+    img = small_image((6, 4))
+    copy = img.copy()
+    copy.row(2, readonly=True)
+    assert copy.pixels is img.pixels
+    copy.row(1)[0] = img.get(1, 0)[0] ^ 1
+    assert img.get(1, 0) != copy.get(1, 0)
+    view = img.row(0)
+    copy = img.copy()
+    gray = list(copy.gray())
+    img.set(1, 1, (1, 2, 3))
+    view[0:3] = b'\x07\x07\x07'
+    assert img.get(0, 0) == (7, 7, 7) and copy.get(0, 0) != (7, 7, 7)
+    assert list(copy.gray()) == gray
+
+
+def test_mapped_image(tmp_path, monkeypatch):
+    img = small_image((8, 8))
+    path = str(tmp_path / 'img.raw')
+    mapped = MyImage.mapped(path, img.size)
+    assert mapped.get(7, 7) == (0, 0, 0)
+    for r in range(8):
+        for c in range(8):
+            mapped.set(r, c, img.get(r, c))
+    mapped.pixels.close()
+
+    mapped = MyImage.mapped(path, readonly=True)
+    assert mapped.size == img.size and list(mapped.pixels) == list(img.pixels)
+    out = MyImage.mapped(str(tmp_path / 'rotated.raw'), (16, 16))
+    assert rotations(mapped, out) is out
+    assert list(out.pixels) == list(rotations(img).pixels)
+    assert list(apply_mask(mapped, 'mask-blur.txt').pixels) == \
+        list(apply_mask(img, 'mask-blur.txt').pixels)
+    # mapped images are masked in bands of rows; make them 3 rows high
+    monkeypatch.setattr(convolution, 'BAND_PIXELS', 24)
+    masked = MyImage.mapped(str(tmp_path / 'masked.raw'), img.size)
+    for mask in MASKS:
+        average = 'blur' in mask
+        assert apply_mask(mapped, mask, average, 'python', out=masked) \
+            is masked
+        assert list(masked.pixels) == \
+            list(apply_mask(img, mask, average, 'python').pixels)
+    with pytest.raises(AssertionError):
+        apply_mask(masked, 'mask-blur.txt', out=masked)
+    with masked.pixels.view() as view:
+        view[0:3] = b'\x01\x02\x03'
+    assert masked.get(0, 0) == (1, 2, 3)
+    view = masked.row(1)
+    with pytest.raises(BufferError):
+        masked.pixels.close()
+    masked.set(0, 0, (4, 5, 6))
+    assert masked.get(0, 0) == (4, 5, 6)
+    view.release()
+    masked.pixels.close()
+    copy = out.copy()
+    out.set(0, 0, (1, 2, 3))
+    assert copy.get(0, 0) != (1, 2, 3)
+    out.pixels.close()
+    out = MyImage.mapped(str(tmp_path / 'rotated.raw'), readonly=True)
+    assert out.get(0, 0) == (1, 2, 3)
+    out.pixels.close()
+    mapped.pixels.close()
+
+    with open(path, 'r+b') as f:
+        f.write(b'PNG!')
+    with pytest.raises(ValueError):
+        MyImage.mapped(path)
+
+
+def test_raw_format(tmp_path):
+    path = str(tmp_path / 'img.raw')
+    for pointer in (False, True):
+        img = small_image((7, 5), pointer, tmp_path)
+        img.save(path)
+        with open(path, 'rb') as f:
+            assert len(f.read()) == 16 + 3 * 7 * 5
+        for load_pointer in (False, True):
+            loaded = MyImage.open(path, pointer=load_pointer)
+            assert loaded.size == (7, 5) and loaded.pointer == load_pointer
+            assert list(loaded.pixels) == list(img.pixels)
+        mapped = MyImage.mapped(path, readonly=True)
+        assert list(mapped.pixels) == list(img.pixels)
+        mapped.pixels.close()
+    with open(path, 'r+b') as f:
+        f.truncate(30)
+    with pytest.raises(ValueError):
+        MyImage.open(path)
+
+
+def test_benchmark_run_and_compare(tmp_path):
+    output = str(tmp_path / 'run.json')
+    assert benchmark.main(['run', '-o', output, '--sizes', '8',
+                           '--mask-sizes', '3', '--repeat', '1']) == 0
+    with open(output) as f:
+        report = json.load(f)
+    engines = ['python'] + ([] if convolution.np is None else ['numpy', 'fft'])
+    for backend in ('array', 'pointer'):
+        for op in ('open', 'save', 'access', 'access_unchecked',
+                   'remove_channel', 'rotations'):
+            assert report['results'][f'{op}/{backend}/8']['seconds'] > 0
+        for kind in benchmark.MASK_KINDS:
+            for engine in engines:
+                key = f'apply_mask/{backend}/8/3/{kind}/{engine}'
+                assert report['results'][key]['retained_blocks'] > 0
+    assert benchmark.main(['compare', output, output]) == 0
+    slower = json.loads(json.dumps(report))
+    slower['results']['rotations/array/8']['seconds'] *= 2
+    assert benchmark.compare(report, slower) == [
+        ('rotations/array/8', 'seconds',
+         report['results']['rotations/array/8']['seconds'],
+         slower['results']['rotations/array/8']['seconds'])]
+
+
+def test_benchmark_measure_cleans_up_on_errors():
+    def failing():
+        raise RuntimeError
+    for repeat in (0, 1):
+        with pytest.raises(RuntimeError):
+            benchmark.measure(failing, repeat)
+        assert gc.isenabled() and not tracemalloc.is_tracing()
+
+
+def test_profile_counters_and_phases():
+    original = MyImage.get
+    with profiling.profile() as stats:
+        img = MyImage.open(SOURCE_IMAGE, pointer=True)
+        img.get(0, 5)
+        img.get(0, 2)
+        img.set(1, 1, (1, 2, 3))
+        apply_mask(img, 'mask-blur.txt')
+    assert MyImage.get is original
+    assert stats.counts['get'] == 2 and stats.counts['set'] == 1
+    width, height = img.size
+    # the skip index is built and tobytes run over every node, and the 3
+    # accesses walk 5, 2 and 1 nodes from the nearest indexed ones
+    assert stats.counts['nodes'] == 2 * width * height + 8
+    # tobytes of the pointer list, then gray plane expanded into the result
+    assert stats.counts['bytes'] == 2 * 3 * width * height
+    for phase in ('open', 'decode', 'unpack', 'load_mask', 'gray',
+                  'convolve', 'expand'):
+        assert stats.calls[phase] == 1, phase
+    assert stats.calls['save'] == 0
+    assert 'convolve' in stats.report()
+    with profiling.profile() as stats:
+        img.get(0, 0)
+        with pytest.raises(AssertionError):
+            with profiling.profile():
+                pass
+    img.get(0, 0)
+    assert stats.counts['get'] == 1
+    with profiling.profile() as stats:
+        assert list(img.pixels)[:2] == [img.get(0, 0), img.get(0, 1)]
+    assert stats.counts['nodes'] == width * height + 1
+
+
+def test_unchecked_accessors(tmp_path):
+    mapped = MyImage.mapped(str(tmp_path / 'img.raw'), (5, 3))
+    for img in (MyImage((5, 3)), MyImage((5, 3), pointer=True), mapped):
+        for r in range(3):
+            for c in range(5):
+                img._set_unchecked(r, c, (r, c, r * c))
+        for r in range(3):
+            for c in range(5):
+                assert img.get(r, c) == img._get_unchecked(r, c) == \
+                    (r, c, r * c)
+    mapped.pixels.close()
+    with pytest.raises(AssertionError, match='list of size 15'):
+        MyImage((5, 3)).pixels[15] = (0, 0, 0)
+
+
+def test_box_mask(tmp_path):
+    img = small_image((11, 7))
+    for size, weight in ((1, 1), (3, 1), (5, 2), (15, 1), (3, -1)):
+        weights = [weight] * size * size
+        maskfile = write_mask(tmp_path, weights)
+        assert convolution.load_mask(maskfile).uniform == weight
+        for average in (True, False):
+            expected = reference_mask(img, weights, average)
+            for engine in ('numpy', 'python'):
+                if engine == 'numpy' and convolution.np is None:
+                    continue
+                assert masked(img, maskfile, average, engine=engine) == \
+                    expected, f'{size}x{size} box of {weight}s, {engine}'
+    assert convolution.load_mask('mask-blur.txt').uniform is None
+
+
+@pytest.mark.skipif(convolution.np is None, reason='numpy is not installed')
+def test_fft_engine(tmp_path):
+    img = small_image((13, 9))
+    weights = [(7 * t) % 11 - 3 for t in range(7 * 7)]
+    maskfile = write_mask(tmp_path, weights)
+    for average in (True, False):
+        assert masked(img, maskfile, average, engine='fft') == \
+            reference_mask(img, weights, average)
+    for maskfile in MASKS:
+        for average in (True, False):
+            assert masked(img, maskfile, average, engine='fft') == \
+                masked(img, maskfile, average, engine='python'), maskfile
+    size = convolution.fft_min_size()
+    assert size == convolution.FFT_MIN_SIZE and size >= 3
+
+
+def test_gray_plane_cache(tmp_path):
+    img = small_image((6, 4))
+    gray = img.gray()
+    assert img.gray() is gray and gray.readonly
+    assert list(gray) == [sum(img.get(r, c)) // 3
+                          for r in range(4) for c in range(6)]
+    expected = apply_mask(img, 'mask-blur.txt')
+    img.set(2, 3, (255, 255, 255))
+    assert img.gray() is not gray and img.gray()[2*6 + 3] == 255
+    assert list(apply_mask(img, 'mask-blur.txt').pixels) != \
+        list(expected.pixels)
+    copy = img.copy()
+    assert copy.gray() is img.gray()
+    img.row(0)[0:3] = b'\0\0\0'
+    assert img.gray()[0] == 0 and img.gray() is not img.gray()
+    assert copy.gray()[0] == sum(copy.get(0, 0)) // 3
+    pointer = small_image((6, 4), True, tmp_path)
+    assert list(pointer.gray()) == list(small_image((6, 4)).gray())
+    for img in (small_image((6, 4)), pointer):
+        img.gray()
+        img.pixels[1] = (30, 30, 30)
+        assert img.gray()[1] == 30
+        img.pixels.set(2, (60, 60, 60))
+        assert img.gray()[2] == 60
+        img.pixels.frombytes(bytes(3 * 6 * 4))
+        assert not any(img.gray())
+
+
+def test_apply_masks_matches_apply_mask(tmp_path):
+    img = small_image((12, 9))
+    maskfiles = MASKS + ['mask-blur.txt', write_mask(tmp_path, [1] * 9)]
+    averages = [True, False, True, False, False, True, False]
+    for engine in ('numpy', 'python', 'fft'):
+        if engine != 'python' and convolution.np is None:
+            continue
+        results = apply_masks(img, maskfiles, averages, engine=engine)
+        for maskfile, average, result in zip(maskfiles, averages, results):
+            assert list(result.pixels) == \
+                masked(img, maskfile, average, engine=engine), maskfile
+    with pytest.raises(ZeroDivisionError):
+        apply_masks(img, ['mask-blur.txt', 'mask-sobel-x.txt'])
+
+
+def test_update_mask_after_edits(tmp_path):
+    even = write_mask(tmp_path,
+                      [1, 2, 0, 1, 3, 1, 1, 0, 2, 1, 1, 1, 0, 1, 2, 1])
+    for pointer, maskfile, engine in ((False, 'mask-blur.txt', 'numpy'),
+                                      (True, 'mask-blur-more.txt', 'python'),
+                                      (False, even, 'python'),
+                                      (False, even, 'numpy')):
+        if engine == 'numpy' and convolution.np is None:
+            continue
+        img = small_image((14, 11), pointer, tmp_path)
+        out = update_mask(img, maskfile, MyImage(img.size), engine=engine)
+        assert list(out.pixels) == masked(img, maskfile, True)
+        assert img.take_dirty() == []
+        for r, c in ((0, 0), (0, 1), (1, 1), (5, 7), (10, 13), (6, 7)):
+            img.set(r, c, (255, 0, 255))
+        dirty = img.take_dirty()
+        assert (0, 0, 2, 2) in dirty and len(dirty) <= 4
+        out.take_dirty()
+        update_mask(img, maskfile, out, engine=engine, rects=dirty)
+        assert list(out.pixels) == masked(img, maskfile, True)
+        assert all(r1 - r0 < 11 and c1 - c0 < 14
+                   for r0, c0, r1, c1 in out.take_dirty())
+
+
+def test_update_mask_through_held_views():
+    img = small_image((9, 8))
+    out = update_mask(img, 'mask-blur.txt', MyImage(img.size))
+    rows = img.region(3, 2, 2, 4)
+    row = img.row(6)
+    update_mask(img, 'mask-blur.txt', out)
+    rows[1][0:3] = row[3:6] = b'\xff\x00\xff'
+    assert img.take_dirty() == [(3, 0, 5, 9), (6, 0, 7, 9)]
+    img.take_dirty()
+    rows[0][6:9] = b'\x00\xff\x00'
+    update_mask(img, 'mask-blur.txt', out)
+    assert list(out.pixels) == masked(img, 'mask-blur.txt', True)
+
+
+def test_pipeline_rejects_clashing_outputs(tmp_path):
+    for name in ('a', 'b'):
+        os.makedirs(str(tmp_path / name))
+        small_image((4, 4)).save(str(tmp_path / name / 'img.png'))
+    with pytest.raises(ValueError, match='img.png'):
+        pipeline.Pipeline().rotations().run(str(tmp_path / '*' / 'img.png'),
+                                            str(tmp_path / 'out'), workers=1)
+    assert not os.path.exists(str(tmp_path / 'out' / 'img.png'))